@@ -0,0 +1,291 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from utils.crypto_utils import (
+    generate_keys, sign_message, verify_signature, serialize_public_key, KEY_ALGORITHMS, ALGORITHM_P256,
+)
+from utils.envelope import encode_envelope, parse_envelope, decode_payload, data_topic, ENVELOPE_FORMATS
+from utils.registry_store import JsonRegistryStore, write_json_atomic
+from utils.key_index import build_key_index
+from broker.keystore import RegistryKeyStore, IndexedKeyStore
+from broker import subscriber
+from broker.event_log import EventLog, VALID
+from broker.telemetry_store import TelemetryStore
+from broker.rollups import window_aggregates
+from utils.transport import InProcessHub, InProcessTransport
+
+# Usage: python -m benchmarks.bench_auth [--quick] [--output bench_results.json]
+# Every result is "per second" or "seconds"; compare files from two commits to
+# spot regressions.
+
+SAMPLE_READING = {"temperature": 23.45, "humidity": 45.67}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def timed(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return time.perf_counter() - started
+
+
+def make_fleet(size):
+    fleet = {}
+    for n in range(size):
+        private_key, public_key = generate_keys()
+        fleet[f"bench{n}"] = (private_key, serialize_public_key(public_key), n + 1)
+    return fleet
+
+
+def fleet_registry(fleet):
+    return {device_id: {"public_key": pem, "index": index} for device_id, (_, pem, index) in fleet.items()}
+
+
+def make_payload(device_id, timestamp=None, seq=0):
+    # seq varies the reading: the replay filter drops identical messages from one device.
+    reading = dict(SAMPLE_READING, temperature=SAMPLE_READING["temperature"] + seq % 1000 / 100)
+    return {"device_id": device_id, **reading, "timestamp": int(timestamp or time.time())}
+
+
+def bench_crypto(iterations):
+    message = json.dumps(make_payload("bench0")).encode()
+    results = {}
+    for algorithm in KEY_ALGORITHMS:
+        private_key, public_key = generate_keys(algorithm)
+        signature = sign_message(private_key, message)
+        sign_seconds = timed(lambda: sign_message(private_key, message), iterations)
+        verify_seconds = timed(lambda: verify_signature(public_key, message, signature), iterations)
+        # P-256 keeps the original unprefixed keys so older result files still compare.
+        prefix = "" if algorithm == ALGORITHM_P256 else f"{algorithm}_"
+        results[f"{prefix}sign_per_sec"] = iterations / sign_seconds
+        results[f"{prefix}verify_per_sec"] = iterations / verify_seconds
+    return results
+
+
+def bench_envelopes(iterations):
+    private_key, _ = generate_keys()
+    payload = make_payload("bench0")
+    topic = data_topic("bench0")
+    results = {}
+    for fmt in ENVELOPE_FORMATS:
+        raw = encode_envelope(private_key, payload, fmt, 1)
+
+        def parse():
+            decode_payload(parse_envelope(raw, topic, lambda index: "bench0"))
+
+        # encode_us includes the signature; see crypto.sign_per_sec for that share.
+        encode_seconds = timed(lambda: encode_envelope(private_key, payload, fmt, 1), iterations)
+        parse_seconds = timed(parse, iterations)
+        results[fmt] = {
+            "bytes": len(raw),
+            "encode_us": encode_seconds / iterations * 1e6,
+            "parse_us": parse_seconds / iterations * 1e6,
+        }
+    return results
+
+
+def bench_registry(sizes, workdir):
+    results = {}
+    for size in sizes:
+        fleet = make_fleet(size)
+        entries = fleet_registry(fleet)
+        json_path = os.path.join(workdir, f"registry_{size}.json")
+        index_path = os.path.join(workdir, f"registry_{size}.idx")
+        write_json_atomic(json_path, entries)
+
+        keystore = RegistryKeyStore(JsonRegistryStore(json_path))
+        started = time.perf_counter()
+        keystore.reload()
+        full_load = time.perf_counter() - started
+        # Keys are built on first use, so the first lookup pays the PEM parse.
+        started = time.perf_counter()
+        keystore.get("bench0")
+        registry_first_lookup = time.perf_counter() - started
+
+        private_key, public_key = generate_keys()
+        entries["bench_new"] = {"public_key": serialize_public_key(public_key), "index": size + 1}
+        write_json_atomic(json_path, entries)
+        started = time.perf_counter()
+        keystore.reload()
+        incremental = time.perf_counter() - started
+
+        started = time.perf_counter()
+        build_key_index(entries, index_path)
+        index_build = time.perf_counter() - started
+
+        indexed = IndexedKeyStore(index_path)
+        started = time.perf_counter()
+        indexed.reload()
+        index_open = time.perf_counter() - started
+        started = time.perf_counter()
+        indexed.get("bench0")
+        first_lookup = time.perf_counter() - started
+
+        results[str(size)] = {
+            "full_load_sec": full_load,
+            "incremental_reload_sec": incremental,
+            "registry_first_lookup_sec": registry_first_lookup,
+            "index_build_sec": index_build,
+            "index_open_sec": index_open,
+            "index_first_lookup_sec": first_lookup,
+        }
+    return results
+
+
+def bench_subscriber(devices, messages, fmt, workdir):
+    fleet = make_fleet(devices)
+    json_path = os.path.join(workdir, "registry.json")
+    write_json_atomic(json_path, fleet_registry(fleet))
+
+    subscriber.log = EventLog(stream=open(os.devnull, "w"))
+    subscriber.keystore = RegistryKeyStore(JsonRegistryStore(json_path))
+    subscriber.telemetry = TelemetryStore(os.path.join(workdir, "telemetry"))
+
+    device_ids = list(fleet)
+    now = time.time()
+    outgoing = []
+    for n in range(messages):
+        device_id = device_ids[n % devices]
+        private_key, _, index = fleet[device_id]
+        raw = encode_envelope(private_key, make_payload(device_id, now, n // devices), fmt, index)
+        outgoing.append((data_topic(device_id), raw))
+
+    sent_at = {}
+    latencies = []
+    done = threading.Event()
+    lock = threading.Lock()
+    original_process_batch = subscriber.process_batch
+
+    def timed_process_batch(batch):
+        original_process_batch(batch)
+        finished = time.perf_counter()
+        with lock:
+            for _, raw, _ in batch:
+                latencies.append(finished - sent_at.pop(id(raw)))
+            if len(latencies) >= messages:
+                done.set()
+
+    subscriber.process_batch = timed_process_batch
+    # The in-process transport keeps the broker's network hop out of the measurement.
+    hub = InProcessHub()
+    receiver = subscriber.start(InProcessTransport("bench_subscriber", hub))
+    publisher = InProcessTransport("bench_publisher", hub)
+    publisher.connect()
+
+    valid_before = subscriber.outcomes_total.values().get((VALID,), 0)
+    started = time.perf_counter()
+    for topic, raw in outgoing:
+        sent_at[id(raw)] = time.perf_counter()
+        publisher.publish(topic, raw)
+    done.wait(timeout=max(30, messages / 100))
+    elapsed = time.perf_counter() - started
+    # Rejected messages finish too (and faster), so only Valid outcomes count.
+    valid = subscriber.outcomes_total.values().get((VALID,), 0) - valid_before
+    stats = subscriber.pipeline.stats.snapshot()
+    subscriber.pipeline.stop()
+    receiver.disconnect()
+    subscriber.telemetry.stop()
+    subscriber.process_batch = original_process_batch
+
+    return {
+        "format": fmt,
+        "devices": devices,
+        "messages": messages,
+        "completed": len(latencies),
+        "valid": valid,
+        "msgs_per_sec": valid / elapsed if elapsed else None,
+        "latency_p50_ms": percentile(latencies, 0.50) * 1000 if latencies else None,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+        "dropped": stats["dropped_newest"] + stats["dropped_oldest"],
+        "stored": subscriber.telemetry.written,
+    }
+
+
+def bench_storage(readings, workdir):
+    store = TelemetryStore(os.path.join(workdir, "storage"))
+    now = time.time()
+    for n in range(readings):
+        store.add(f"device{n % 100}", make_payload(f"device{n % 100}", now), now)
+    started = time.perf_counter()
+    store.flush()
+    elapsed = time.perf_counter() - started
+    store.stop()
+    return {"readings": readings, "rows_per_sec": readings / elapsed if elapsed else None}
+
+
+def bench_rollups(readings, devices=1000):
+    rng = np.random.default_rng(0)
+    device_ids = np.array([f"device{n}" for n in range(devices)], dtype=object)[rng.integers(0, devices, readings)]
+    times = time.time() + rng.random(readings) * 3600
+    values = rng.normal(25.0, 3.0, readings)
+    started = time.perf_counter()
+    result = window_aggregates(device_ids, times, values, 60)
+    elapsed = time.perf_counter() - started
+    return {"readings": readings, "groups": len(result["count"]),
+            "readings_per_sec": readings / elapsed if elapsed else None}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the authentication hot paths.")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes for a fast smoke run")
+    parser.add_argument("--format", choices=ENVELOPE_FORMATS, default="detached", help="envelope used end-to-end")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    iterations = 200 if args.quick else 2000
+    sizes = [100, 1000] if args.quick else [100, 1000, 10000]
+    devices, messages = (50, 1000) if args.quick else (500, 20000)
+
+    results = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "timestamp": int(time.time()),
+    }
+    print("⏱  crypto...", flush=True)
+    results["crypto"] = bench_crypto(iterations)
+    print("⏱  envelopes...", flush=True)
+    results["envelopes"] = bench_envelopes(iterations)
+    print("⏱  registry...", flush=True)
+    with tempfile.TemporaryDirectory(prefix="iot-bench-") as workdir:
+        results["registry"] = bench_registry(sizes, workdir)
+        print("⏱  storage...", flush=True)
+        results["storage"] = bench_storage(messages * 5, workdir)
+        print("⏱  rollups...", flush=True)
+        results["rollups"] = bench_rollups(messages * 100)
+        print("⏱  subscriber...", flush=True)
+        results["subscriber"] = bench_subscriber(devices, messages, args.format, workdir)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"✅ Results written to {args.output}")
+    valid = results["subscriber"]["valid"]
+    if valid != messages:
+        print(f"❌ Subscriber accepted {valid} of {messages} messages; throughput is not comparable.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
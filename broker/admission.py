@@ -0,0 +1,142 @@
+import threading
+import time
+from collections import OrderedDict
+from utils.crypto_utils import key_algorithm, ALGORITHM_ED25519
+from utils.envelope import ENVELOPE_JSON, ENVELOPE_DETACHED, ENVELOPE_SESSION
+from config import (
+    ADMISSION_RATE, ADMISSION_BURST, ADMISSION_MAX_PAYLOAD, ADMISSION_MAX_DEVICES,
+    ADMISSION_UNREGISTERED_TTL, ADMISSION_INVALID_LIMIT, ADMISSION_INVALID_WINDOW, ADMISSION_BLOCK_SECONDS,
+)
+
+# Admission control in front of signature verification. admit() runs on the
+# transport's delivery thread, before a message is queued, and only looks at
+# the topic and payload length; check_envelope() runs on the verifier once the
+# envelope is parsed and the key is known. Neither costs more than a dict
+# lookup, so junk traffic is turned away without spending a verify on it.
+
+OVERSIZED = "oversized"
+MALFORMED = "malformed"
+RATE_LIMITED = "rate_limited"
+UNREGISTERED = "unregistered"
+BLOCKED = "blocked"
+ADMISSION_REASONS = (OVERSIZED, MALFORMED, RATE_LIMITED, UNREGISTERED, BLOCKED)
+
+# DER-encoded P-256 signatures are at most 72 bytes; Ed25519 ones always 64.
+MAX_DER_SIGNATURE = 72
+ED25519_SIGNATURE_SIZE = 64
+
+
+def plausible_signature(signature, public_key):
+    if key_algorithm(public_key) == ALGORITHM_ED25519:
+        return len(signature) == ED25519_SIGNATURE_SIZE
+    # SEQUENCE tag, then a one-byte length covering the rest.
+    return (8 <= len(signature) <= MAX_DER_SIGNATURE and signature[0] == 0x30
+            and signature[1] == len(signature) - 2)
+
+
+class AdmissionControl:
+    # Per-device token buckets, plus temporary bans: ids that turned out to be
+    # unregistered, and devices whose signatures failed invalid_limit times
+    # within invalid_window. Each table is an LRU bounded by max_devices.
+    def __init__(self, rate=ADMISSION_RATE, burst=ADMISSION_BURST, max_payload=ADMISSION_MAX_PAYLOAD,
+                 max_devices=ADMISSION_MAX_DEVICES, unregistered_ttl=ADMISSION_UNREGISTERED_TTL,
+                 invalid_limit=ADMISSION_INVALID_LIMIT, invalid_window=ADMISSION_INVALID_WINDOW,
+                 block_seconds=ADMISSION_BLOCK_SECONDS):
+        self.rate = rate
+        self.burst = burst
+        self.max_payload = max_payload
+        self.max_devices = max_devices
+        self.unregistered_ttl = unregistered_ttl
+        self.invalid_limit = invalid_limit
+        self.invalid_window = invalid_window
+        self.block_seconds = block_seconds
+        self._buckets = OrderedDict()
+        self._bans = OrderedDict()
+        self._failures = OrderedDict()
+        self._lock = threading.Lock()
+        self.rejected = {reason: 0 for reason in ADMISSION_REASONS}
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        return reason
+
+    def _remember(self, table, key, value):
+        table[key] = value
+        table.move_to_end(key)
+        if len(table) > self.max_devices:
+            table.popitem(last=False)
+
+    def admit(self, device_id, size, now=None):
+        # Returns None, or the reason the message is turned away.
+        if self.max_payload and size > self.max_payload:
+            return self._reject(OVERSIZED)
+        if not device_id:
+            return self._reject(MALFORMED)
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            ban = self._bans.get(device_id)
+            if ban is not None:
+                until, reason = ban
+                if until > now:
+                    return self._reject(reason)
+                del self._bans[device_id]
+            if not self.rate:
+                return None
+            bucket = self._buckets.get(device_id)
+            if bucket is None:
+                tokens = self.burst
+                bucket = [tokens, now]
+                self._remember(self._buckets, device_id, bucket)
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                self._buckets.move_to_end(device_id)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                return self._reject(RATE_LIMITED)
+            bucket[0] = tokens - 1
+        return None
+
+    def check_envelope(self, envelope, public_key, timestamp):
+        # Structural checks before crypto; timestamp is claimed_timestamp(envelope).
+        if envelope.format == ENVELOPE_SESSION:
+            return None
+        if not isinstance(timestamp, (int, float)) or isinstance(timestamp, bool):
+            return self._reject(MALFORMED)
+        if envelope.format in (ENVELOPE_JSON, ENVELOPE_DETACHED) and not plausible_signature(envelope.signature,
+                                                                                           public_key):
+            return self._reject(MALFORMED)
+        return None
+
+    def mark_unregistered(self, device_id, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._remember(self._bans, device_id, (now + self.unregistered_ttl, UNREGISTERED))
+
+    def forget_unregistered(self):
+        # After a registry reload, ids banned as unknown may have been registered.
+        with self._lock:
+            for device_id in [d for d, (_, reason) in self._bans.items() if reason == UNREGISTERED]:
+                del self._bans[device_id]
+
+    def record_invalid(self, device_id, now=None):
+        # Returns True when this failure got the device blocked.
+        if not self.invalid_limit:
+            return False
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            failures = self._failures.get(device_id)
+            if failures is None or now - failures[1] > self.invalid_window:
+                failures = [0, now]
+            failures[0] += 1
+            if failures[0] < self.invalid_limit:
+                self._remember(self._failures, device_id, failures)
+                return False
+            self._failures.pop(device_id, None)
+            self._remember(self._bans, device_id, (now + self.block_seconds, BLOCKED))
+            return True
+
+    def record_valid(self, device_id):
+        if device_id in self._failures:
+            with self._lock:
+                self._failures.pop(device_id, None)
@@ -0,0 +1,71 @@
+import argparse
+import functools
+import os
+from utils.envelope import topic_shard
+from utils.supervisor import ManagedProcess, Supervisor, python_module
+from config import CLUSTER_MODE, CLUSTER_SIZE, CLUSTER_SHARE_GROUP, TOPIC_PATTERN, TOPIC_SHARDS
+
+print = functools.partial(print, flush=True)
+
+# Subscriber group. In "partitioned" mode each member subscribes only to the
+# topic shards it owns (shard % partitions == partition; devices publish to
+# their shard, see utils/envelope.py), so the broker sends every member just
+# its own devices and a device's replay window and session always live in one
+# process. In
+# "shared" mode the broker load-balances an MQTT v5 shared subscription;
+# nothing pins a device to a member there, so replay windows are per member
+# and session mode is not supported.
+#
+# Usage: python -m broker.cluster [--size N] [--mode partitioned|shared]
+
+CLUSTER_MODES = ("partitioned", "shared")
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def device_partition(device_id, partitions):
+    return topic_shard(device_id) % partitions
+
+
+def partition_patterns(pattern, partition, partitions, shards=TOPIC_SHARDS):
+    # "iot/+/data/+" -> ["iot/+/data/<shard>", ...] for the shards this member owns.
+    prefix = pattern.rsplit("/", 1)[0]
+    return [f"{prefix}/{shard}" for shard in range(partition, shards, partitions)]
+
+
+def shared_topic(pattern, group=CLUSTER_SHARE_GROUP):
+    return f"$share/{group}/{pattern}"
+
+
+# Logged by a subscriber once its registry is loaded and it is subscribed.
+SUBSCRIBER_READY = "Subscribed to topic pattern"
+
+
+def member_processes(size, mode):
+    return [
+        ManagedProcess(
+            f"subscriber-{n}",
+            python_module("broker.subscriber", "--partition", n, "--partitions", size, "--mode", mode),
+            cwd=BASE_DIR,
+            env={"PYTHONPATH": os.pathsep.join(filter(None, [BASE_DIR, os.environ.get("PYTHONPATH")]))},
+            ready_pattern=SUBSCRIBER_READY,
+        )
+        for n in range(size)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run and supervise a group of subscribers.")
+    parser.add_argument("--size", type=int, default=CLUSTER_SIZE or os.cpu_count(), help="number of subscribers")
+    parser.add_argument("--mode", choices=CLUSTER_MODES, default=CLUSTER_MODE)
+    args = parser.parse_args()
+
+    size = max(1, args.size)
+    print(f"📡 Starting {size} subscribers ({args.mode}) for {TOPIC_PATTERN}")
+    supervisor = Supervisor(member_processes(size, args.mode))
+    supervisor.start_all()
+    supervisor.run()
+    print("🛑 Subscriber group stopped.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import json
+import sys
+import threading
+import time
+from collections import deque
+
+# Structured subscriber log. The verifier threads only append a small tuple;
+# a background writer formats records and writes them in one batch per
+# flush interval, so stdout (usually a pipe read by the GUI) never blocks the
+# hot path. Valid results are sampled once an interval gets busy, failures
+# are always written, and every interval ends with per-device counts.
+
+LOG_FORMATS = ("text", "json")
+
+VALID = "valid"
+INVALID = "invalid"
+UNREGISTERED = "unregistered"
+ERROR = "error"
+
+
+def print_line(message):
+    # Default report hook for components used outside the subscriber, which
+    # hands them log.info instead so every line goes through the log.
+    print(message, flush=True)
+
+
+class EventLog:
+    def __init__(self, stream=None, fmt="text", sample_every=100, sample_after=20,
+                 summary_interval=10, flush_interval=0.2, max_pending=100000):
+        if fmt not in LOG_FORMATS:
+            raise ValueError(f"Unknown log format: {fmt}")
+        self.stream = stream or sys.stdout
+        self.fmt = fmt
+        self.sample_every = max(1, sample_every)
+        self.sample_after = sample_after
+        self.summary_interval = summary_interval
+        self.flush_interval = flush_interval
+        self.pending = deque(maxlen=max_pending)
+        self.dropped = 0
+        self._counts = {}
+        self._valid_seen = 0
+        self._interval_started = time.time()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _append(self, record):
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+        self.pending.append(record)
+
+    def _count(self, device_id, outcome):
+        with self._lock:
+            counts = self._counts.get(device_id)
+            if counts is None:
+                counts = self._counts[device_id] = {}
+            counts[outcome] = counts.get(outcome, 0) + 1
+            if outcome == VALID:
+                self._valid_seen += 1
+                return self._valid_seen
+        return 0
+
+    def info(self, message):
+        self._append((time.time(), "info", None, None, message))
+
+    def valid(self, device_id, payload):
+        seen = self._count(device_id, VALID)
+        if seen <= self.sample_after or seen % self.sample_every == 0:
+            self._append((time.time(), VALID, device_id, None, payload))
+
+    def reject(self, device_id, reason, message):
+        # reason is one of the outcome constants or a replay/session rejection
+        # name; message is the human-readable line.
+        self._count(device_id, reason)
+        self._append((time.time(), "reject", device_id, reason, message))
+
+    def count(self, device_id, reason):
+        # Counted in the interval summary only, for high-volume rejections.
+        self._count(device_id, reason)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="event-log", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.flush_interval)
+            if time.time() - self._interval_started >= self.summary_interval:
+                self._summarize()
+            self.flush()
+
+    def _summarize(self):
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            self._valid_seen = 0
+            started, self._interval_started = self._interval_started, time.time()
+        if counts:
+            self._append((time.time(), "summary", None, round(time.time() - started, 1), counts))
+
+    def flush(self):
+        lines = []
+        pending = self.pending
+        while pending:
+            try:
+                record = pending.popleft()
+            except IndexError:
+                break
+            lines.append(self._format(record))
+        if self.dropped:
+            lines.append(self._format((time.time(), "info", None, None,
+                                       f"Log writer fell behind; {self.dropped} records dropped.")))
+            self.dropped = 0
+        if not lines:
+            return
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+        except (BrokenPipeError, ValueError):
+            pass
+
+    def _format(self, record):
+        ts, kind, device_id, reason, detail = record
+        if self.fmt == "json":
+            entry = {"ts": round(ts, 3), "event": kind}
+            if device_id is not None:
+                entry["device_id"] = device_id
+            if kind == VALID:
+                entry["payload"] = detail
+            elif kind == "summary":
+                entry["seconds"] = reason
+                entry["devices"] = detail
+            else:
+                if reason is not None:
+                    entry["reason"] = reason
+                entry["message"] = detail
+            return json.dumps(entry, default=str)
+
+        if kind == VALID:
+            return f"Valid signature from {device_id}: {detail}"
+        if kind == "summary":
+            return summary_line(reason, detail)
+        return detail
+
+
+def summary_line(seconds, counts):
+    totals = {}
+    failing = []
+    for device_id, outcomes in counts.items():
+        for outcome, n in outcomes.items():
+            totals[outcome] = totals.get(outcome, 0) + n
+        failures = sum(n for outcome, n in outcomes.items() if outcome != VALID)
+        if failures:
+            failing.append((failures, device_id))
+    failing.sort(reverse=True)
+    parts = ", ".join(f"{n} {outcome}" for outcome, n in sorted(totals.items()))
+    line = f"Summary ({seconds}s): {parts} from {len(counts)} devices"
+    if failing:
+        line += "; most failures: " + ", ".join(f"{device_id} ({n})" for n, device_id in failing[:5])
+    return line
@@ -0,0 +1,52 @@
+import threading
+from collections import OrderedDict
+from config import KEY_CACHE_SIZE
+
+
+class KeyCache:
+    # LRU of materialized key objects, capped at max_entries (None: unbounded)
+    # so memory follows the set of devices that are actually sending.
+    def __init__(self, max_entries=KEY_CACHE_SIZE, previous=None):
+        self.max_entries = max_entries
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        # Counters survive the cache being replaced on a registry reload.
+        self.hits = previous.hits if previous else 0
+        self.misses = previous.misses if previous else 0
+        self.evictions = previous.evictions if previous else 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, device_id):
+        with self._lock:
+            key = self._keys.get(device_id)
+            if key is None:
+                self.misses += 1
+                return None
+            self._keys.move_to_end(device_id)
+            self.hits += 1
+            return key
+
+    def put(self, device_id, key):
+        with self._lock:
+            self._keys[device_id] = key
+            self._keys.move_to_end(device_id)
+            if self.max_entries is not None:
+                while len(self._keys) > self.max_entries:
+                    self._keys.popitem(last=False)
+                    self.evictions += 1
+
+    def items(self):
+        # Least recently used first, so put()ting them in order keeps the ranking.
+        with self._lock:
+            return list(self._keys.items())
+
+    def stats(self):
+        return {
+            "entries": len(self._keys),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
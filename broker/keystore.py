@@ -0,0 +1,180 @@
+import os
+from collections import namedtuple
+from utils.crypto_utils import deserialize_public_key, public_key_from_point, public_key_to_point, key_algorithm, ALGORITHM_P256
+from utils.key_index import KeyIndex, KeyIndexError
+from utils.registry_store import open_registry_store, RegistryError
+from broker.key_cache import KeyCache
+from broker.event_log import print_line
+from config import USE_KEY_INDEX, KEY_INDEX_PATH, KEY_CACHE_SIZE
+
+# Key stores answer two questions for the subscriber: which key belongs to a
+# device id, and which device id a binary envelope's registry index refers to.
+# Both publish their state as one immutable snapshot so a reload is a single
+# reference swap.
+
+RegistrySnapshot = namedtuple("RegistrySnapshot", ["entries", "keys", "index", "stamp", "invalid"])
+IndexSnapshot = namedtuple("IndexSnapshot", ["key_index", "keys", "stamp"])
+
+
+class RegistryKeyStore:
+    # Keeps the registry entries as loaded and builds a key object the first
+    # time a device is seen; reloads only compare entries, no key is parsed.
+    def __init__(self, store=None, cache_size=KEY_CACHE_SIZE, report=print_line):
+        self.store = store or open_registry_store()
+        self.cache_size = cache_size
+        self.report = report
+        self.snapshot = RegistrySnapshot({}, KeyCache(cache_size), {}, None, set())
+
+    @property
+    def source(self):
+        return self.store.path
+
+    def __len__(self):
+        return len(self.snapshot.entries)
+
+    def __contains__(self, device_id):
+        return device_id in self.snapshot.entries
+
+    def stamp(self):
+        return self.store.stamp()
+
+    def changed(self):
+        return self.stamp() != self.snapshot.stamp
+
+    def cache_stats(self):
+        return self.snapshot.keys.stats()
+
+    def get(self, device_id):
+        snapshot = self.snapshot
+        public_key = snapshot.keys.get(device_id)
+        if public_key is not None:
+            return public_key
+        info = snapshot.entries.get(device_id)
+        if info is None or device_id in snapshot.invalid:
+            return None
+        try:
+            public_key = deserialize_public_key(info.get("public_key"))
+            # The registered algorithm must match the key, so a P-256 device
+            # can never be verified as Ed25519 or the other way round.
+            algorithm = info.get("algorithm", ALGORITHM_P256)
+            if key_algorithm(public_key) != algorithm:
+                raise ValueError(f"key is not {algorithm}")
+        except Exception as e:
+            snapshot.invalid.add(device_id)
+            self.report(f"Skipping registry entry {device_id}: {e}")
+            return None
+        snapshot.keys.put(device_id, public_key)
+        return public_key
+
+    def device_for_index(self, device_index):
+        return self.snapshot.index.get(device_index)
+
+    def reload(self):
+        current = self.snapshot
+        stamp = self.stamp()
+        if stamp is None:
+            self.snapshot = RegistrySnapshot({}, KeyCache(self.cache_size, current.keys), {}, None, set())
+            return f"Registry {self.source} not found."
+
+        try:
+            entries = self.store.load()
+        except RegistryError as e:
+            # Keep serving the last good snapshot and retry once the store changes again.
+            self.snapshot = current._replace(stamp=stamp)
+            return f"Failed to load registry: {e}"
+
+        def same_key(device_id):
+            info, previous = entries.get(device_id), current.entries.get(device_id)
+            return (info is not None and previous is not None
+                    and info.get("public_key") == previous.get("public_key")
+                    and info.get("algorithm", ALGORITHM_P256) == previous.get("algorithm", ALGORITHM_P256))
+
+        changed = sum(1 for device_id in entries if not same_key(device_id))
+        removed = sum(1 for device_id in current.entries if device_id not in entries)
+        # Carry over materialized keys (and known-bad entries) whose key did not change.
+        keys = KeyCache(self.cache_size, current.keys)
+        for device_id, public_key in current.keys.items():
+            if same_key(device_id):
+                keys.put(device_id, public_key)
+        invalid = {device_id for device_id in current.invalid if same_key(device_id)}
+        index = {info["index"]: device_id for device_id, info in entries.items() if "index" in info}
+        self.snapshot = RegistrySnapshot(entries, keys, index, stamp, invalid)
+        return (f"Reloaded device registry: {len(entries)} devices "
+                f"({changed} added/changed, {removed} removed), {len(keys)} keys kept warm.")
+
+
+class IndexedKeyStore:
+    # Maps the precompiled key index and only builds key objects for devices
+    # that actually send traffic.
+    def __init__(self, path=KEY_INDEX_PATH, cache_size=KEY_CACHE_SIZE):
+        self.path = path
+        self.cache_size = cache_size
+        self.snapshot = IndexSnapshot(None, KeyCache(cache_size), None)
+
+    @property
+    def source(self):
+        return self.path
+
+    def __len__(self):
+        key_index = self.snapshot.key_index
+        return len(key_index) if key_index is not None else 0
+
+    def stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def changed(self):
+        return self.stamp() != self.snapshot.stamp
+
+    def cache_stats(self):
+        return self.snapshot.keys.stats()
+
+    def __contains__(self, device_id):
+        key_index = self.snapshot.key_index
+        return key_index is not None and key_index.find(device_id) is not None
+
+    def get(self, device_id):
+        snapshot = self.snapshot
+        public_key = snapshot.keys.get(device_id)
+        if public_key is not None or snapshot.key_index is None:
+            return public_key
+        found = snapshot.key_index.lookup(device_id)
+        if found is None:
+            return None
+        public_key = public_key_from_point(found[0])
+        snapshot.keys.put(device_id, public_key)
+        return public_key
+
+    def device_for_index(self, device_index):
+        key_index = self.snapshot.key_index
+        return key_index.device_for_index(device_index) if key_index is not None else None
+
+    def reload(self):
+        current = self.snapshot
+        try:
+            key_index = KeyIndex(self.path)
+        except FileNotFoundError:
+            self.snapshot = IndexSnapshot(None, KeyCache(self.cache_size, current.keys), None)
+            return f"Key index {self.path} not found."
+        except KeyIndexError as e:
+            self.snapshot = current._replace(stamp=self.stamp())
+            return f"Failed to load key index: {e}"
+
+        # Carry over materialized keys whose point did not change. Old caches are
+        # left to the garbage collector since other threads may still read them.
+        keys = KeyCache(self.cache_size, current.keys)
+        for device_id, public_key in current.keys.items():
+            found = key_index.lookup(device_id)
+            if found is not None and found[0] == public_key_to_point(public_key):
+                keys.put(device_id, public_key)
+        self.snapshot = IndexSnapshot(key_index, keys, key_index.stamp)
+        return f"Mapped key index: {len(key_index)} devices, {len(keys)} keys kept warm."
+
+
+def open_keystore(use_index=USE_KEY_INDEX, report=print_line):
+    if use_index:
+        return IndexedKeyStore()
+    return RegistryKeyStore(report=report)
@@ -0,0 +1,184 @@
+import bisect
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# Subscriber instrumentation in Prometheus text format. Counters and
+# histograms are sharded per thread: the thread that records a value only
+# touches its own shard, so the hot path takes no lock, and a scrape sums
+# the shards. Gauges are callables evaluated at scrape time, and so are
+# observed counters: totals another component already keeps, exposed with the
+# counter type so rate() works on them.
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class _Sharded:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def _collect(self):
+        with self._lock:
+            shards = list(self._shards)
+        return [dict(shard) for shard in shards]
+
+
+class Counter(_Sharded):
+    kind = "counter"
+
+    def inc(self, key=(), amount=1):
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + amount
+
+    def values(self):
+        totals = {}
+        for shard in self._collect():
+            for key, value in shard.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def total(self):
+        return sum(self.values().values())
+
+    def render(self):
+        return [f"{self.name}{_labels(self.labels, key)} {value}" for key, value in sorted(self.values().items())]
+
+
+class Histogram(_Sharded):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, times=1):
+        shard = self._shard()
+        if not shard:
+            shard["counts"] = [0] * (len(self.buckets) + 1)
+            shard["sum"] = 0.0
+        shard["counts"][bisect.bisect_left(self.buckets, value)] += times
+        shard["sum"] += value * times
+
+    def render(self):
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        for shard in self._collect():
+            if not shard:
+                continue
+            for i, n in enumerate(shard["counts"]):
+                counts[i] += n
+            total += shard["sum"]
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help = help_text
+        self.read = read
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception:
+            return []
+        return [] if value is None else [f"{self.name} {value}"]
+
+
+class ObservedCounter(Gauge):
+    kind = "counter"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.register(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help_text, buckets))
+
+    def gauge(self, name, help_text, read):
+        return self.register(Gauge(name, help_text, read))
+
+    def observed_counter(self, name, help_text, read):
+        return self.register(ObservedCounter(name, help_text, read))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(registry, port, host="127.0.0.1", routes=None):
+    # routes: {path: handler(query params) -> JSON-serializable answer}
+    routes = routes or {}
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path, _, query = self.path.partition("?")
+            if path in routes:
+                body = json.dumps(routes[path](parse_qs(query))).encode()
+                content_type = "application/json"
+            elif path == "/metrics":
+                body = registry.render().encode()
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
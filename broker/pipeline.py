@@ -0,0 +1,154 @@
+import queue
+import threading
+import time
+from broker.event_log import print_line
+
+OVERFLOW_POLICIES = ("drop_newest", "drop_oldest", "block")
+
+
+class PipelineStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.processed = 0
+        self.batches = 0
+        self.dropped_newest = 0
+        self.dropped_oldest = 0
+        self.blocked = 0
+        self.max_depth = 0
+
+    def add(self, field, amount=1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + amount)
+
+    def observe_depth(self, depth):
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "enqueued": self.enqueued,
+                "processed": self.processed,
+                "batches": self.batches,
+                "dropped_newest": self.dropped_newest,
+                "dropped_oldest": self.dropped_oldest,
+                "blocked": self.blocked,
+                "max_depth": self.max_depth,
+            }
+
+
+class VerificationPipeline:
+    # The MQTT callback only calls submit(); everything expensive runs on the
+    # worker threads, which drain the bounded queue in micro-batches.
+    def __init__(self, process_batch, workers=4, batch_size=32, queue_size=10000,
+                 overflow_policy="drop_oldest", block_timeout=0.5, report=print_line):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.process_batch = process_batch
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.report = report
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats = PipelineStats()
+        self._threads = []
+        self._stopping = threading.Event()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"verifier-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        for _ in self._threads:
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                pass
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def submit(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if not self._handle_overflow(item):
+                return False
+        self.stats.add("enqueued")
+        self.stats.observe_depth(self.queue.qsize())
+        return True
+
+    def _handle_overflow(self, item):
+        if self.overflow_policy == "drop_newest":
+            self.stats.add("dropped_newest")
+            return False
+
+        if self.overflow_policy == "block":
+            self.stats.add("blocked")
+            try:
+                self.queue.put(item, timeout=self.block_timeout)
+                return True
+            except queue.Full:
+                self.stats.add("dropped_newest")
+                return False
+
+        # drop_oldest: make room by evicting the head of the queue.
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.stats.add("dropped_oldest")
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(item)
+                return True
+            except queue.Full:
+                continue
+
+    def _next_batch(self):
+        item = self.queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        while len(batch) < self.batch_size:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._stopping.set()
+                break
+            batch.append(item)
+        return batch
+
+    def _worker(self):
+        while not self._stopping.is_set():
+            batch = self._next_batch()
+            if batch is None:
+                break
+            try:
+                self.process_batch(batch)
+            except Exception as e:
+                self.report(f"Verifier batch failed: {e}")
+            self.stats.add("processed", len(batch))
+            self.stats.add("batches")
+
+
+def report_stats_periodically(pipeline, interval=10, report=print_line):
+    last = pipeline.stats.snapshot()
+    while True:
+        time.sleep(interval)
+        current = pipeline.stats.snapshot()
+        rate = (current["processed"] - last["processed"]) / interval
+        dropped = current["dropped_newest"] + current["dropped_oldest"]
+        report(f"Pipeline: {rate:.0f} msg/s, depth {pipeline.depth()}, "
+               f"dropped {dropped}, blocked {current['blocked']}")
+        last = current
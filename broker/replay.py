@@ -0,0 +1,85 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class ReplayFilter:
+    # check() runs before signature verification and only rejects, it never
+    # records anything: an unverified message must not be able to move a
+    # device's window. commit() records the message once it has verified.
+    # Duplicates are keyed on the signed bytes and the device id rather than
+    # the signature, which an attacker can re-encode without the key (ECDSA's
+    # (r, s) and (r, n - s) both verify).
+    def __init__(self, skew=30, max_age=300, max_devices=100000,
+                 digest_capacity=100000, digest_ttl=600):
+        self.skew = skew
+        self.max_age = max_age
+        self.max_devices = max_devices
+        self.digest_capacity = digest_capacity
+        self.digest_ttl = digest_ttl
+        self._last_seen = OrderedDict()
+        self._digests = OrderedDict()
+        self._lock = threading.Lock()
+        self.rejected = {"duplicate": 0, "stale": 0, "future": 0}
+
+    @staticmethod
+    def digest(device_id, message):
+        digest = hashlib.blake2b(device_id.encode(), digest_size=16)
+        digest.update(b"\0")
+        digest.update(message)
+        return digest.digest()
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        return reason
+
+    def _expire_digests(self, now):
+        digests = self._digests
+        while digests:
+            oldest, expires_at = next(iter(digests.items()))
+            if expires_at > now and len(digests) <= self.digest_capacity:
+                break
+            digests.popitem(last=False)
+
+    def check(self, device_id, timestamp, message, now=None):
+        now = time.time() if now is None else now
+        digest = self.digest(device_id, message)
+        with self._lock:
+            expires_at = self._digests.get(digest)
+            if expires_at is not None and expires_at > now:
+                return self._reject("duplicate")
+            if timestamp is None:
+                return None
+            if timestamp > now + self.skew:
+                return self._reject("future")
+            if timestamp < now - self.max_age:
+                return self._reject("stale")
+            last = self._last_seen.get(device_id)
+            if last is not None and timestamp < last - self.skew:
+                return self._reject("stale")
+        return None
+
+    def commit(self, device_id, timestamp, message, now=None):
+        now = time.time() if now is None else now
+        digest = self.digest(device_id, message)
+        with self._lock:
+            expires_at = self._digests.get(digest)
+            if expires_at is not None and expires_at > now:
+                # Two copies raced through check(); only the first one wins.
+                return self._reject("duplicate")
+            self._digests[digest] = now + self.digest_ttl
+            self._digests.move_to_end(digest)
+            self._expire_digests(now)
+
+            if timestamp is not None:
+                last = self._last_seen.get(device_id)
+                if last is None or timestamp > last:
+                    self._last_seen[device_id] = timestamp
+                self._last_seen.move_to_end(device_id)
+                while len(self._last_seen) > self.max_devices:
+                    self._last_seen.popitem(last=False)
+        return None
+
+    def __len__(self):
+        return len(self._digests)
@@ -0,0 +1,296 @@
+import argparse
+import functools
+import json
+import sqlite3
+import threading
+import time
+import urllib.parse
+import urllib.request
+import numpy as np
+from broker.telemetry_store import partition_files, quote, RESERVED_COLUMNS
+from config import (
+    TELEMETRY_DIR, TELEMETRY_PARTITION_SECONDS, ROLLUP_FIELDS, ROLLUP_WINDOW, ROLLUP_PERCENTILES,
+    ROLLUP_KEEP_WINDOWS, METRICS_HOST, METRICS_PORT,
+)
+
+print = functools.partial(print, flush=True)
+
+# Per-device, per-window min/max/mean/percentile rollups of stored telemetry.
+# Readings are loaded as NumPy columns (device, receive time, value) and
+# aggregated in one sort: after ordering by (device, window, value) every
+# group is a contiguous run, so min/max/percentiles are index lookups and
+# sums a single reduceat. Windows are aligned to receive time, the clock the
+# store partitions by; device clocks are not trusted. On/off style text values
+# (device2's "status") count as 1/0, so their mean is the duty cycle.
+
+BOOLEAN_VALUES = {"ON": 1.0, "TRUE": 1.0, "OFF": 0.0, "FALSE": 0.0}
+EMPTY = np.zeros(0)
+
+
+def to_numeric(column):
+    try:
+        return np.array(column, dtype=np.float64)
+    except (TypeError, ValueError):
+        return np.array([
+            BOOLEAN_VALUES.get(value.upper(), np.nan) if isinstance(value, str)
+            else np.nan if value is None else value
+            for value in column
+        ], dtype=np.float64)
+
+
+def factorize(devices):
+    # (sorted unique names, code per reading); a dict pass beats sorting strings.
+    codes = {}
+    device_codes = np.fromiter((codes.setdefault(device, len(codes)) for device in devices),
+                               dtype=np.int64, count=len(devices))
+    names = np.array(list(codes), dtype=object)
+    order = np.argsort(names.astype(str))
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return names[order], rank[device_codes]
+
+
+def window_aggregates(devices, times, values, window=ROLLUP_WINDOW, percentiles=ROLLUP_PERCENTILES):
+    # Columnar result: {"device_id", "window_start", "count", "min", "max", "mean", "p50", ...}
+    keep = ~np.isnan(values)
+    devices, times, values = np.asarray(devices, dtype=object)[keep], times[keep], values[keep]
+    names = ["device_id", "window_start", "count", "min", "max", "mean"] + [f"p{q:g}" for q in percentiles]
+    if not len(values):
+        return {name: EMPTY for name in names}
+
+    device_names, device_codes = factorize(devices)
+    windows = np.floor(times / window).astype(np.int64)
+    first_window = windows.min()
+    groups = device_codes * (windows.max() - first_window + 1) + (windows - first_window)
+    order = np.lexsort((values, groups))
+    groups, device_codes, windows, values = groups[order], device_codes[order], windows[order], values[order]
+    boundaries = np.flatnonzero(groups[1:] != groups[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(values)]))
+    counts = ends - starts
+
+    result = {
+        "device_id": device_names[device_codes[starts]],
+        "window_start": windows[starts] * window,
+        "count": counts,
+        "min": values[starts],
+        "max": values[ends - 1],
+        "mean": np.add.reduceat(values, starts) / counts,
+    }
+    for q in percentiles:
+        # Linear interpolation between the closest ranks, like np.percentile.
+        position = starts + (counts - 1) * (q / 100)
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        result[f"p{q:g}"] = values[low] + (values[high] - values[low]) * (position - low)
+    return result
+
+
+def concat(parts):
+    parts = [part for part in parts if len(part["count"])]
+    if not parts:
+        return None
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+
+def rows(result):
+    if result is None or not len(result["count"]):
+        return []
+    columns = {name: values.tolist() for name, values in result.items()}
+    return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+
+def load_field(field, start=None, end=None, device_ids=None, directory=TELEMETRY_DIR,
+               partition_seconds=TELEMETRY_PARTITION_SECONDS):
+    # (devices, times, values) for every stored reading that has the field.
+    devices, times, values = [], [], []
+    for partition, _, path in partition_files(directory):
+        if (end is not None and partition >= end) or (start is not None and partition + partition_seconds <= start):
+            continue
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=30)
+        try:
+            tables = conn.execute("SELECT name, fields FROM schemas").fetchall()
+            for table, fields in tables:
+                if field not in json.loads(fields) or field in RESERVED_COLUMNS:
+                    continue
+                query = f"SELECT device_id, received, {quote(field)} FROM {table} WHERE 1"
+                params = []
+                if start is not None:
+                    query += " AND received >= ?"
+                    params.append(start)
+                if end is not None:
+                    query += " AND received < ?"
+                    params.append(end)
+                if device_ids:
+                    query += f" AND device_id IN ({', '.join('?' * len(device_ids))})"
+                    params.extend(device_ids)
+                found = conn.execute(query, params).fetchall()
+                if found:
+                    columns = list(zip(*found))
+                    devices.append(np.array(columns[0], dtype=object))
+                    times.append(np.array(columns[1], dtype=np.float64))
+                    values.append(to_numeric(columns[2]))
+        except sqlite3.Error as e:
+            print(f"⚠️ Skipping {path}: {e}")
+        finally:
+            conn.close()
+    if not devices:
+        return np.zeros(0, dtype=object), EMPTY, EMPTY
+    return np.concatenate(devices), np.concatenate(times), np.concatenate(values)
+
+
+def rollup(field, window=ROLLUP_WINDOW, start=None, end=None, device_ids=None,
+           percentiles=ROLLUP_PERCENTILES, directory=TELEMETRY_DIR):
+    devices, times, values = load_field(field, start, end, device_ids, directory)
+    return window_aggregates(devices, times, values, window, percentiles)
+
+
+class LiveRollups:
+    # Kept up to date from the telemetry store's writer (TelemetryStore.on_write).
+    # The newest two windows stay open as raw columns so slightly late readings
+    # still land in their window; older windows are aggregated once, kept for
+    # keep_windows windows, and readings arriving for them are counted as late.
+    def __init__(self, fields=ROLLUP_FIELDS, window=ROLLUP_WINDOW, percentiles=ROLLUP_PERCENTILES,
+                 keep_windows=ROLLUP_KEEP_WINDOWS):
+        self.fields = tuple(fields)
+        self.window = window
+        self.percentiles = percentiles
+        self.keep_windows = keep_windows
+        self.late = 0
+        self._open = {field: [] for field in self.fields}
+        self._closed = {field: None for field in self.fields}
+        self._closed_before = None
+        self._latest = None
+        self._lock = threading.Lock()
+
+    def observe(self, groups):
+        # groups: {partition: {schema: [(device_id, ts, received, *fields)]}}
+        with self._lock:
+            for tables in groups.values():
+                for schema, table_rows in tables.items():
+                    tracked = [field for field in schema if field in self._open]
+                    if not tracked:
+                        continue
+                    columns = list(zip(*table_rows))
+                    devices = np.array(columns[0], dtype=object)
+                    times = np.array(columns[2], dtype=np.float64)
+                    if self._closed_before is not None:
+                        on_time = times >= self._closed_before
+                        self.late += int(len(times) - np.count_nonzero(on_time)) * len(tracked)
+                        devices, times = devices[on_time], times[on_time]
+                    else:
+                        on_time = slice(None)
+                    if not len(times):
+                        continue
+                    self._latest = max(self._latest or 0.0, float(times.max()))
+                    for field in tracked:
+                        values = to_numeric(columns[len(RESERVED_COLUMNS) + schema.index(field)])[on_time]
+                        self._open[field].append((devices, times, values))
+            self._close_windows()
+
+    def _close_windows(self):
+        if self._latest is None:
+            return
+        newest = int(self._latest // self.window)
+        closed_before = (newest - 1) * self.window
+        if self._closed_before is not None and closed_before <= self._closed_before:
+            return
+        self._closed_before = closed_before
+        oldest_kept = (newest - self.keep_windows) * self.window
+        for field in self.fields:
+            devices, times, values = self._columns(field)
+            closing = times < closed_before
+            if np.any(closing):
+                done = window_aggregates(devices[closing], times[closing], values[closing],
+                                         self.window, self.percentiles)
+                previous = self._closed[field]
+                self._closed[field] = concat([previous, done]) if previous is not None else done
+                still_open = ~closing
+                self._open[field] = [(devices[still_open], times[still_open], values[still_open])]
+            closed = self._closed[field]
+            if closed is not None:
+                keep = closed["window_start"] >= oldest_kept
+                self._closed[field] = {name: column[keep] for name, column in closed.items()}
+
+    def _columns(self, field):
+        chunks = self._open[field]
+        if not chunks:
+            return np.zeros(0, dtype=object), EMPTY, EMPTY
+        return tuple(np.concatenate([chunk[i] for chunk in chunks]) for i in range(3))
+
+    def snapshot(self, field, device_ids=None):
+        if field not in self._open:
+            raise KeyError(field)
+        with self._lock:
+            devices, times, values = self._columns(field)
+            current = window_aggregates(devices, times, values, self.window, self.percentiles)
+            result = concat([part for part in (self._closed[field], current) if part is not None])
+        if result is not None and device_ids:
+            keep = np.isin(result["device_id"], list(device_ids))
+            result = {name: column[keep] for name, column in result.items()}
+        return result
+
+    def query(self, params):
+        # Handler for GET /rollups?field=...&device_id=... on the metrics endpoint.
+        field = params.get("field", [self.fields[0]])[0]
+        try:
+            result = self.snapshot(field, params.get("device_id"))
+        except KeyError:
+            return {"error": f"not tracked: {field}", "fields": list(self.fields)}
+        return {"field": field, "window": self.window, "late": self.late, "rollups": rows(result)}
+
+
+def print_table(field, result):
+    table = rows(result)
+    if not table:
+        print(f"No stored readings with {field}.")
+        return
+    columns = list(table[0])
+    print(f"📊 {field}")
+    print("  ".join(f"{name:>19}" if name == "window_start" else f"{name:>10}" for name in columns))
+    for row in table:
+        cells = []
+        for name in columns:
+            value = row[name]
+            if name == "window_start":
+                cells.append(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(value)))
+            elif isinstance(value, float):
+                cells.append(f"{value:>10.2f}")
+            else:
+                cells.append(f"{value:>10}")
+        print("  ".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-device telemetry rollups over time windows.")
+    parser.add_argument("fields", nargs="*", default=list(ROLLUP_FIELDS), help="reading fields to aggregate")
+    parser.add_argument("--window", type=float, default=ROLLUP_WINDOW, help="window length in seconds")
+    parser.add_argument("--since", type=float, default=3600, help="only readings from the last N seconds")
+    parser.add_argument("--device", action="append", help="limit to a device (repeatable)")
+    parser.add_argument("--dir", default=TELEMETRY_DIR, help="telemetry directory")
+    parser.add_argument("--live", action="store_true",
+                        help="ask the running subscriber for its live rollups instead of reading files")
+    parser.add_argument("--json", action="store_true", help="print JSON rows")
+    args = parser.parse_args()
+
+    for field in args.fields:
+        if args.live:
+            query = urllib.parse.urlencode({"field": field, "device_id": args.device or []}, doseq=True)
+            with urllib.request.urlopen(f"http://{METRICS_HOST}:{METRICS_PORT}/rollups?{query}", timeout=5) as reply:
+                answer = json.load(reply)
+            if "error" in answer:
+                print(f"❌ {answer['error']} (live fields: {', '.join(answer['fields'])})")
+                continue
+            table = answer.get("rollups", [])
+            result = {name: np.array([row[name] for row in table]) for name in table[0]} if table else None
+        else:
+            result = rollup(field, args.window, time.time() - args.since, None, args.device,
+                            directory=args.dir)
+        if args.json:
+            print(json.dumps({"field": field, "rollups": rows(result)}))
+        else:
+            print_table(field, result)
+
+
+if __name__ == "__main__":
+    main()
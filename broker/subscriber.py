@@ -1,85 +1,464 @@
-import json
-import os
 import paho.mqtt.client as mqtt
+import argparse
+import atexit
+import signal
 import threading
 import time
-from utils.crypto_utils import verify_signature, deserialize_public_key
-from config import REGISTRY_PATH, MQTT_BROKER, MQTT_PORT, TOPIC_PATTERN
-import functools
+from concurrent.futures import ProcessPoolExecutor
+from utils.crypto_utils import verify_signature, verify_raw, public_key_to_point, public_key_from_point
+from config import (
+    REGISTRY_POLL_INTERVAL, TOPIC_PATTERN, TOPIC_SHARDS, SESSION_INIT_PATTERN,
+    LEGACY_TOPICS, LEGACY_TOPIC_PATTERN, LEGACY_SESSION_INIT_PATTERN,
+    VERIFY_WORKERS, VERIFY_WORKER_KIND, VERIFY_BATCH_SIZE,
+    INGEST_QUEUE_SIZE, INGEST_OVERFLOW_POLICY, PIPELINE_STATS_INTERVAL,
+    REPLAY_SKEW, REPLAY_MAX_AGE, REPLAY_MAX_DEVICES, REPLAY_DIGEST_CAPACITY, REPLAY_DIGEST_TTL,
+    LOG_FORMAT, LOG_SAMPLE_VALID, LOG_SAMPLE_AFTER, LOG_SUMMARY_INTERVAL, LOG_FLUSH_INTERVAL,
+    METRICS_PORT, METRICS_HOST, METRICS_PER_DEVICE, CLUSTER_MODE, AUTH_MODE, KEY_CACHE_SIZE,
+    ADMISSION_CONTROL, TRACE_SAMPLE_EVERY, TRACE_REPORT_INTERVAL, PROFILE_SECONDS,
+)
+from utils.envelope import (
+    parse_envelope, decode_payload, claimed_timestamp, device_id_from_topic, verify_envelope,
+    ENVELOPE_SESSION, ENVELOPE_BATCH, RAW_SIGNATURE_FORMATS,
+)
+from utils.session import SessionTable, UNKNOWN_SESSION
+from broker.pipeline import VerificationPipeline, report_stats_periodically
+from broker.replay import ReplayFilter
+from broker.admission import AdmissionControl
+from broker.keystore import open_keystore
+from broker.key_cache import KeyCache
+from broker.telemetry_store import open_telemetry_store
+from broker.rollups import LiveRollups
+from utils.transport import create_transport
+from broker.event_log import EventLog, VALID, INVALID, UNREGISTERED, ERROR
+from broker.metrics import MetricsRegistry, serve_metrics
+from broker.cluster import device_partition, partition_patterns, shared_topic
+from broker.tracing import Tracer, SamplingProfiler
+from utils.transport import TRANSPORT_MQTT
 
-print = functools.partial(print, flush=True)  
+log = EventLog(
+    fmt=LOG_FORMAT,
+    sample_every=LOG_SAMPLE_VALID,
+    sample_after=LOG_SAMPLE_AFTER,
+    summary_interval=LOG_SUMMARY_INTERVAL,
+    flush_interval=LOG_FLUSH_INTERVAL,
+)
 
-device_registry = {}
-public_keys = {}
+def report(message):
+    # Status lines from the key store, pipeline and telemetry store go
+    # through whichever log is current, so JSON output stays one record per line.
+    log.info(message)
+
+keystore = open_keystore(report=report)
+pipeline = None
+verify_pool = None
+sessions = SessionTable()
+replay_filter = ReplayFilter(
+    skew=REPLAY_SKEW,
+    max_age=REPLAY_MAX_AGE,
+    max_devices=REPLAY_MAX_DEVICES,
+    digest_capacity=REPLAY_DIGEST_CAPACITY,
+    digest_ttl=REPLAY_DIGEST_TTL,
+)
+admission = AdmissionControl() if ADMISSION_CONTROL else None
+tracer = Tracer(TRACE_SAMPLE_EVERY) if TRACE_SAMPLE_EVERY else None
+profiler = SamplingProfiler()
+transport = None
+telemetry = open_telemetry_store(report=report)
+rollups = LiveRollups() if telemetry is not None else None
+# Cluster membership (see broker/cluster.py); the defaults mean "only member".
+partition = 0
+partitions = 1
+cluster_mode = CLUSTER_MODE
+partitioned = False
+
+metrics = MetricsRegistry()
+received_total = metrics.counter("iot_messages_received_total", "Messages handed over by the transport.")
+outcomes_total = metrics.counter("iot_messages_processed_total", "Processed messages by outcome.", ("outcome",))
+device_received_total = metrics.counter(
+    "iot_device_messages_received_total", "Messages received per device.", ("device_id",))
+device_outcomes_total = metrics.counter(
+    "iot_device_messages_processed_total", "Processed messages per device and outcome.", ("device_id", "outcome"))
+verify_seconds = metrics.histogram("iot_verify_seconds", "Signature verification time per message.")
+end_to_end_seconds = metrics.histogram("iot_end_to_end_seconds", "Time from receipt to result per message.")
+admission_rejected_total = metrics.counter(
+    "iot_admission_rejected_total", "Messages turned away before verification.", ("reason",))
+registry_reloads_total = metrics.counter("iot_registry_reloads_total", "Registry reloads.")
+last_reload_seconds = None
+if tracer is not None:
+    metrics.register(tracer.seconds)
+    metrics.register(tracer.samples)
+metrics.gauge("iot_registry_devices", "Devices in the loaded registry.", lambda: len(keystore))
+metrics.gauge("iot_registry_reload_seconds", "Duration of the last registry reload.", lambda: last_reload_seconds)
+metrics.gauge("iot_ingest_queue_depth", "Messages waiting for a verifier.", lambda: pipeline.depth())
+metrics.observed_counter("iot_ingest_dropped_total", "Messages dropped by the ingest queue overflow policy.",
+                         lambda: sum(pipeline.stats.snapshot()[k] for k in ("dropped_newest", "dropped_oldest")))
+metrics.gauge("iot_sessions_active", "Established device sessions.", lambda: len(sessions))
+metrics.gauge("iot_telemetry_pending", "Verified readings waiting to be stored.",
+              lambda: len(telemetry.pending) if telemetry else 0)
+metrics.observed_counter("iot_telemetry_written_total", "Verified readings stored.",
+                         lambda: telemetry.written if telemetry else 0)
+metrics.observed_counter("iot_telemetry_dropped_total", "Verified readings dropped because the store fell behind.",
+                         lambda: telemetry.dropped if telemetry else 0)
+metrics.observed_counter("iot_telemetry_rejected_total", "Verified readings the store could not write.",
+                         lambda: telemetry.rejected if telemetry else 0)
+metrics.gauge("iot_key_cache_entries", "Materialized public keys.", lambda: keystore.cache_stats()["entries"])
+metrics.observed_counter("iot_key_cache_hits_total", "Key lookups served from the key cache.",
+                         lambda: keystore.cache_stats()["hits"])
+metrics.observed_counter("iot_key_cache_misses_total", "Key lookups that missed the key cache.",
+                         lambda: keystore.cache_stats()["misses"])
+metrics.observed_counter("iot_key_cache_evictions_total", "Keys evicted from the key cache.",
+                         lambda: keystore.cache_stats()["evictions"])
+
+def device_label(device_id):
+    # Only registered ids become label values; ids a client makes up share
+    # one series, so junk traffic cannot grow the scrape without bound.
+    return device_id if device_id and device_id in keystore else UNREGISTERED
+
+def accept(device_id, payload):
+    outcomes_total.inc((VALID,))
+    if METRICS_PER_DEVICE:
+        device_outcomes_total.inc((device_id, VALID))
+    log.valid(device_id, payload)
+    if telemetry is not None:
+        telemetry.add(device_id, payload)
+
+def reject(device_id, reason, message):
+    outcomes_total.inc((reason,))
+    if METRICS_PER_DEVICE:
+        device_outcomes_total.inc((device_label(device_id), reason))
+    log.reject(device_id, reason, message)
+
+def refuse(device_id, reason):
+    # Admission rejections: counted, but not logged one by one since they may be a flood.
+    admission_rejected_total.inc((reason,))
+    if METRICS_PER_DEVICE:
+        device_outcomes_total.inc((device_label(device_id), reason))
+    log.count(device_id, reason)
 
 def load_registry():
-    global device_registry, public_keys
-    if not os.path.exists(REGISTRY_PATH):
-        print(f"Registry file {REGISTRY_PATH} not found.")
-        device_registry = {}
-        public_keys = {}
-        return
+    global last_reload_seconds
+    started = time.perf_counter()
+    message = keystore.reload()
+    last_reload_seconds = time.perf_counter() - started
+    registry_reloads_total.inc()
+    if admission is not None:
+        admission.forget_unregistered()
+    log.info(message)
 
-    with open(REGISTRY_PATH, "r") as f:
-        try:
-            device_registry = json.load(f)
-        except json.JSONDecodeError:
-            print("Failed to decode registry JSON.")
-            device_registry = {}
-
-    public_keys = {
-        device_id: deserialize_public_key(info["public_key"])
-        for device_id, info in device_registry.items()
-    }
-    print(f"Reloaded device registry: {len(public_keys)} devices loaded.")
-
-def reload_registry_periodically(interval=60):
+def watch_registry(interval=REGISTRY_POLL_INTERVAL):
     while True:
-        load_registry()
         time.sleep(interval)
+        if keystore.changed():
+            load_registry()
 
-def on_connect(client, userdata, flags, rc):
-    print(f"Connected to MQTT broker with code {rc}")
-    client.subscribe(TOPIC_PATTERN)
-    print(f"Subscribed to topic pattern: {TOPIC_PATTERN}")
+def on_connect(client):
+    log.info(f"Connected to {type(client).__name__}")
+    patterns = [TOPIC_PATTERN, SESSION_INIT_PATTERN]
+    legacy = [LEGACY_TOPIC_PATTERN, LEGACY_SESSION_INIT_PATTERN] if LEGACY_TOPICS else []
+    shards = None
+    if partitioned:
+        shards = partition_patterns(TOPIC_PATTERN, partition, partitions)
+        patterns = shards + partition_patterns(SESSION_INIT_PATTERN, partition, partitions)
+    patterns += legacy
+    if partitions > 1 and cluster_mode == "shared":
+        patterns = [shared_topic(pattern) for pattern in patterns]
+    for pattern in patterns:
+        client.subscribe(pattern)
+    line = f"Subscribed to topic pattern: {TOPIC_PATTERN if partitioned else patterns[0]}"
+    if shards is not None:
+        line += f" ({len(shards)} of {TOPIC_SHARDS} shards)"
+    if legacy:
+        line += f", plus legacy {LEGACY_TOPIC_PATTERN}"
+    log.info(line)
 
-def on_message(client, userdata, msg):
-    print(f"Message received on topic {msg.topic}: {msg.payload.decode()}")
-    try:
-        data = json.loads(msg.payload.decode())
-        payload = data["payload"]
-        signature = bytes.fromhex(data["signature"])
-        device_id = payload.get("device_id")
+def is_handshake(topic):
+    return (mqtt.topic_matches_sub(SESSION_INIT_PATTERN, topic)
+            or (LEGACY_TOPICS and mqtt.topic_matches_sub(LEGACY_SESSION_INIT_PATTERN, topic)))
 
-        if not device_id:
-            print("Missing device_id in payload.")
+def on_message(client, userdata, msg):
+    # Runs on the transport's delivery thread (the paho network loop, or the
+    # publisher itself in-process): hand the raw bytes over and return.
+    # A publisher using another device's shard still cannot reach the wrong member.
+    if partitioned and device_partition(device_id_from_topic(msg.topic) or "", partitions) != partition:
+        return
+    received_total.inc()
+    if admission is not None:
+        device_id = device_id_from_topic(msg.topic)
+        reason = admission.admit(device_id, len(msg.payload))
+        if reason is not None:
+            refuse(device_id, reason)
             return
+    pipeline.submit((msg.topic, msg.payload, time.perf_counter()))
 
-        if device_id not in public_keys:
-            print(f"Unregistered device: {device_id}")
-            return
+def prepare_message(topic, raw, trace=None):
+    envelope = parse_envelope(raw, topic, keystore.device_for_index)
+    device_id = envelope.device_id
+    if trace is not None:
+        trace.mark("parse")
+
+    if not device_id:
+        reject(None, ERROR, "Missing device_id in payload.")
+        return None
+
+    public_key = keystore.get(device_id)
+    if trace is not None:
+        trace.mark("lookup")
+    if public_key is None:
+        if admission is not None:
+            admission.mark_unregistered(device_id)
+        reject(device_id, UNREGISTERED, f"Unregistered device: {device_id}")
+        return None
 
-        message_bytes = json.dumps(payload).encode()
-        valid = verify_signature(public_keys[device_id], message_bytes, signature)
+    timestamp = claimed_timestamp(envelope)
+    if admission is not None:
+        reason = admission.check_envelope(envelope, public_key, timestamp)
+        if reason is not None:
+            refuse(device_id, reason)
+            return None
 
-        if valid:
-            print(f"Valid signature from {device_id}: {payload}")
-        else:
-            print(f"Invalid signature from {device_id}: {payload}")
+    reason = replay_filter.check(device_id, timestamp, envelope.message)
+    if reason is not None:
+        reject(device_id, reason, f"Rejected {reason} message from {device_id}")
+        return None
+    if trace is not None:
+        trace.mark("checks")
 
+    if envelope.format == ENVELOPE_SESSION:
+        # HMAC check is cheap enough to do inline; no need to batch it.
+        valid, reason = sessions.verify(envelope)
+        if trace is not None:
+            trace.mark("verify")
+        if not valid:
+            reject(device_id, INVALID, f"Rejected session message from {device_id}: {reason}")
+            if reason == UNKNOWN_SESSION:
+                rejection = sessions.rejection(envelope)
+                if rejection is not None:
+                    transport.publish(*rejection, qos=1)
+            return None
+        report_result(envelope, True, trace)
+        return None
+
+    return envelope, public_key
+
+def handle_handshake(topic, raw):
+    device_id = device_id_from_topic(topic)
+    public_key = keystore.get(device_id)
+    if public_key is None:
+        if admission is not None:
+            admission.mark_unregistered(device_id)
+        reject(device_id, UNREGISTERED, f"Unregistered device: {device_id}")
+        return
+    try:
+        ack_topic, ack = sessions.handshake(raw, topic, public_key)
     except Exception as e:
-        print(f"Error processing message: {e}")
+        reject(device_id, INVALID, f"Rejected session handshake from {device_id}: {e}")
+        return
+    transport.publish(ack_topic, ack, qos=1)
+    log.info(f"Session established for {device_id} ({len(sessions)} active).")
+
+def prune_sessions_periodically(interval=60):
+    while True:
+        time.sleep(interval)
+        sessions.prune()
 
-def main():
+def report_result(envelope, valid, trace=None):
+    device_id = envelope.device_id
+    if not valid:
+        reject(device_id, INVALID, f"Invalid signature from {device_id}")
+        if admission is not None and admission.record_invalid(device_id):
+            log.info(f"Blocking {device_id} for {admission.block_seconds}s after repeated invalid signatures.")
+        return
+    if admission is not None:
+        admission.record_valid(device_id)
+    try:
+        envelope = decode_payload(envelope)
+    except Exception as e:
+        reject(device_id, INVALID, f"Rejected payload from {device_id}: {e}")
+        return
+    if trace is not None:
+        trace.mark("decode")
+    reason = replay_filter.commit(device_id, envelope.payload.get("timestamp"), envelope.message)
+    if trace is not None:
+        trace.mark("commit")
+    if reason is not None:
+        reject(device_id, reason, f"Rejected {reason} message from {device_id}")
+        return
+    if envelope.format == ENVELOPE_BATCH:
+        # One signature covered the whole batch; each reading is reported on its own.
+        for reading in envelope.payload["readings"]:
+            accept(device_id, reading)
+    else:
+        accept(device_id, envelope.payload)
+    if trace is not None:
+        trace.mark("report")
+
+_process_keys = KeyCache(KEY_CACHE_SIZE)
+
+def verify_with_points(items):
+    # Executed inside verifier processes; keys are rebuilt once per process.
+    results = []
+    for point, message_bytes, signature, raw in items:
+        public_key = _process_keys.get(point)
+        if public_key is None:
+            public_key = public_key_from_point(point)
+            _process_keys.put(point, public_key)
+        verify = verify_raw if raw else verify_signature
+        results.append(verify(public_key, message_bytes, signature))
+    return results
+
+def verify_batch(jobs):
+    # The key's type (P-256 or Ed25519, per the registry entry) picks the algorithm.
+    if verify_pool is None:
+        return [verify_envelope(public_key, env) for env, public_key in jobs]
+    items = [
+        (public_key_to_point(public_key), bytes(env.message), env.signature, env.format in RAW_SIGNATURE_FORMATS)
+        for env, public_key in jobs
+    ]
+    return verify_pool.submit(verify_with_points, items).result()
+
+def process_batch(batch):
+    jobs = []
+    traces = []
+    for topic, raw, _ in batch:
+        if METRICS_PER_DEVICE:
+            device_received_total.inc((device_label(device_id_from_topic(topic)),))
+        if is_handshake(topic):
+            handle_handshake(topic, raw)
+            continue
+        trace = tracer.start() if tracer is not None else None
+        try:
+            job = prepare_message(topic, raw, trace)
+        except Exception as e:
+            reject(device_id_from_topic(topic), ERROR, f"Error processing message: {e}")
+            continue
+        if job is not None:
+            jobs.append(job)
+            traces.append(trace)
+        elif trace is not None:
+            tracer.finish(trace)
+
+    if jobs:
+        try:
+            started = time.perf_counter()
+            results = verify_batch(jobs)
+            per_job = (time.perf_counter() - started) / len(jobs)
+            verify_seconds.observe(per_job, len(jobs))
+        except Exception as e:
+            results = None
+            for envelope, _ in jobs:
+                reject(envelope.device_id, ERROR, f"Error processing message: {e}")
+        if results is not None:
+            for (envelope, _), valid, trace in zip(jobs, results, traces):
+                if trace is not None:
+                    # The batch is verified at once; each message is charged its share.
+                    trace.add("verify", per_job)
+                report_result(envelope, valid, trace)
+                if trace is not None:
+                    tracer.finish(trace)
+
+    finished = time.perf_counter()
+    for _, _, received in batch:
+        end_to_end_seconds.observe(finished - received)
+
+def start_pipeline():
+    global pipeline, verify_pool
+    if VERIFY_WORKER_KIND == "process":
+        verify_pool = ProcessPoolExecutor(max_workers=VERIFY_WORKERS)
+
+    pipeline = VerificationPipeline(
+        process_batch,
+        workers=VERIFY_WORKERS,
+        batch_size=VERIFY_BATCH_SIZE,
+        queue_size=INGEST_QUEUE_SIZE,
+        overflow_policy=INGEST_OVERFLOW_POLICY,
+        report=report,
+    )
+    pipeline.start()
+    threading.Thread(target=report_stats_periodically, args=(pipeline, PIPELINE_STATS_INTERVAL, report),
+                     daemon=True).start()
+    log.info(f"Verification pipeline started: {VERIFY_WORKERS} {VERIFY_WORKER_KIND} workers, "
+             f"batch {VERIFY_BATCH_SIZE}, queue {INGEST_QUEUE_SIZE} ({INGEST_OVERFLOW_POLICY}).")
+
+def report_traces_periodically(interval=TRACE_REPORT_INTERVAL):
+    while True:
+        time.sleep(interval)
+        line = tracer.summary()
+        if line is not None:
+            log.info(line)
+
+def start_profile(seconds=PROFILE_SECONDS):
+    started = profiler.start(seconds, lambda path: log.info(f"Profile written to {path}"))
+    log.info(f"Recording a {seconds:g}s profile..." if started else "A profile is already being recorded.")
+    return started
+
+def profile_route(params):
+    # GET /profile?seconds=N on the metrics endpoint.
+    try:
+        seconds = float(params.get("seconds", [PROFILE_SECONDS])[0])
+    except ValueError:
+        return {"error": "seconds must be a number"}
+    return {"started": start_profile(seconds), "seconds": seconds, "directory": profiler.directory}
+
+def start(client=None):
+    # Also used to embed the subscriber next to in-process publishers.
+    global transport
+    log.start()
+    atexit.register(log.stop)
+    if telemetry is not None:
+        telemetry.on_write = rollups.observe if rollups is not None else None
+        telemetry.start()
+        # Registered after the log so it is stopped (and flushed) first.
+        atexit.register(telemetry.stop)
+        log.info(f"Storing verified telemetry in {telemetry.directory}/")
+    if partitions > 1:
+        log.info(f"Cluster member {partition + 1}/{partitions} ({cluster_mode}).")
+        if cluster_mode == "shared" and AUTH_MODE == "session":
+            log.info("Warning: session mode needs device affinity; use the partitioned cluster mode.")
+    if METRICS_PORT:
+        # Members on one host each take their own port.
+        port = METRICS_PORT + partition
+        try:
+            routes = {"/profile": profile_route}
+            if rollups is not None:
+                routes["/rollups"] = rollups.query
+            serve_metrics(metrics, port, METRICS_HOST, routes)
+            log.info(f"Metrics available at http://{METRICS_HOST}:{port}/metrics")
+        except OSError as e:
+            log.info(f"Metrics endpoint disabled: {e}")
+    if hasattr(signal, "SIGUSR1"):
+        try:
+            signal.signal(signal.SIGUSR1, lambda signum, frame: start_profile())
+        except ValueError:
+            pass  # not the main thread, e.g. embedded in a simulator
+    if tracer is not None:
+        threading.Thread(target=report_traces_periodically, daemon=True).start()
     load_registry()
-    threading.Thread(target=reload_registry_periodically, daemon=True).start()
+    threading.Thread(target=watch_registry, daemon=True).start()
+    threading.Thread(target=prune_sessions_periodically, daemon=True).start()
+    start_pipeline()
 
-    client = mqtt.Client()
-    client.on_connect = on_connect
-    client.on_message = on_message
+    if client is None and cluster_mode == "shared" and partitions > 1:
+        client = create_transport(TRANSPORT_MQTT, protocol=mqtt.MQTTv5)
+    transport = client or create_transport()
+    transport.on_connect = on_connect
+    transport.on_message = on_message
+    transport.connect()
+    return transport
 
-    client.connect(MQTT_BROKER, MQTT_PORT, 60)
-    client.loop_forever()
+def main(argv=None):
+    global partition, partitions, partitioned, cluster_mode
+    parser = argparse.ArgumentParser(description="Verify signed device telemetry.")
+    parser.add_argument("--partition", type=int, default=0, help="this member's number within the group")
+    parser.add_argument("--partitions", type=int, default=1, help="number of subscribers in the group")
+    parser.add_argument("--mode", choices=("partitioned", "shared"), default=CLUSTER_MODE)
+    args = parser.parse_args(argv)
+    if not 0 <= args.partition < args.partitions:
+        parser.error("--partition must be between 0 and --partitions - 1")
+    if args.mode == "partitioned" and args.partitions > TOPIC_SHARDS:
+        parser.error(f"--partitions can be at most TOPIC_SHARDS ({TOPIC_SHARDS}) in partitioned mode")
+    partition, partitions, cluster_mode = args.partition, args.partitions, args.mode
+    partitioned = partitions > 1 and cluster_mode == "partitioned"
+    start().loop_forever()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,285 @@
+import calendar
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from broker.event_log import print_line
+from config import (
+    TELEMETRY_STORE, TELEMETRY_DIR, TELEMETRY_PARTITION_SECONDS, TELEMETRY_MAX_FILE_BYTES,
+    TELEMETRY_FLUSH_INTERVAL, TELEMETRY_MAX_PENDING,
+)
+
+# Storage stage after verification. Verifier threads append one tuple per
+# accepted reading; a background writer groups the pending readings by schema
+# (their set of field names) and bulk-inserts each group with executemany in
+# one transaction per flush. Each schema gets its own table with one column
+# per field. Files are SQLite in WAL mode, one per TELEMETRY_PARTITION_SECONDS
+# of receive time, and a partition rolls over to a new file once it grows past
+# TELEMETRY_MAX_FILE_BYTES. A reading SQLite refuses is dropped on its own
+# (counted in rejected) and the rest of its group is still written; a group
+# that cannot be written at all is retried next flush, the groups committed
+# alongside it are not.
+# Cluster members may share a directory, so table names are picked under a
+# write lock from the file's own schemas table.
+
+# Columns every table has; payload fields with these names are not stored.
+RESERVED_COLUMNS = ("device_id", "ts", "received")
+FILE_PATTERN = re.compile(r"^telemetry-(\d{8}T\d{6})(?:-(\d+))?\.db$")
+# Errors caused by a row's values rather than the database.
+ROW_ERRORS = (sqlite3.IntegrityError, sqlite3.InterfaceError, sqlite3.ProgrammingError, OverflowError)
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def partition_start(received, seconds=TELEMETRY_PARTITION_SECONDS):
+    return int(received // seconds * seconds)
+
+
+def partition_path(directory, start, seq=0):
+    stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(start))
+    return os.path.join(directory, f"telemetry-{stamp}" + (f"-{seq}" if seq else "") + ".db")
+
+
+def partition_files(directory=TELEMETRY_DIR):
+    # [(partition start, sequence, path)] in time order.
+    files = []
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return files
+    for name in names:
+        match = FILE_PATTERN.match(name)
+        if match:
+            start = calendar.timegm(time.strptime(match.group(1), "%Y%m%dT%H%M%S"))
+            files.append((start, int(match.group(2) or 0), os.path.join(directory, name)))
+    files.sort()
+    return files
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def flatten(payload):
+    # {"device_id", "timestamp", ...fields} or with the fields nested under "data".
+    if not isinstance(payload, dict):
+        return None, {"value": payload}
+    fields = {}
+    for name, value in payload.items():
+        if name == "data" and isinstance(value, dict):
+            fields.update(value)
+        elif name != "timestamp":
+            fields[name] = value
+    for name in RESERVED_COLUMNS:
+        fields.pop(name, None)
+    for name, value in fields.items():
+        if isinstance(value, int) and not INT64_MIN <= value <= INT64_MAX:
+            # SQLite integers are 64-bit; larger ones are kept as REAL.
+            fields[name] = float(value)
+        elif value is not None and not isinstance(value, (int, float, str)):
+            fields[name] = json.dumps(value, default=str)
+    return payload.get("timestamp"), fields
+
+
+class TelemetryStore:
+    def __init__(self, directory=TELEMETRY_DIR, partition_seconds=TELEMETRY_PARTITION_SECONDS,
+                 max_file_bytes=TELEMETRY_MAX_FILE_BYTES, flush_interval=TELEMETRY_FLUSH_INTERVAL,
+                 max_pending=TELEMETRY_MAX_PENDING, report=print_line):
+        self.directory = directory
+        self.partition_seconds = partition_seconds
+        self.max_file_bytes = max_file_bytes
+        self.flush_interval = flush_interval
+        self.pending = deque(maxlen=max_pending)
+        self.dropped = 0
+        self.rejected = 0
+        self.written = 0
+        self.batches = 0
+        self.report = report
+        # Called from the writer with {partition: {schema: rows}} after each flush.
+        self.on_write = None
+        self._conn = None
+        self._partition = None
+        self._seq = 0
+        self._tables = {}
+        self._retry = []
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def add(self, device_id, payload, received=None):
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+        self.pending.append((received or time.time(), device_id, payload))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="telemetry-store", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(10)
+            self._thread = None
+        self.flush()
+        with self._flush_lock:
+            self._close()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                # flush() already kept what it could; the writer has to survive.
+                self.report(f"⚠️ Telemetry store flush failed: {e}")
+
+    def flush(self):
+        with self._flush_lock:
+            records, self._retry = self._retry, []
+            pending = self.pending
+            while pending:
+                try:
+                    records.append(pending.popleft())
+                except IndexError:
+                    break
+            if not records:
+                return 0
+            # {partition: {schema: rows}}, and the records behind each group
+            groups = {}
+            by_group = {}
+            for record in records:
+                received, device_id, payload = record
+                ts, fields = flatten(payload)
+                schema = tuple(sorted(fields))
+                partition = partition_start(received, self.partition_seconds)
+                rows = groups.setdefault(partition, {}).setdefault(schema, [])
+                rows.append((device_id, ts, received, *(fields[name] for name in schema)))
+                by_group.setdefault((partition, schema), []).append(record)
+            written = {}
+            for partition in sorted(groups):
+                tables, failed = self._write(partition, groups[partition])
+                if tables:
+                    written[partition] = tables
+                for schema, error in failed.items():
+                    retry = by_group[partition, schema]
+                    self._requeue(retry)
+                    self.report(f"⚠️ Telemetry store write failed, retrying {len(retry)} readings: {error}")
+            count = sum(len(rows) for tables in written.values() for rows in tables.values())
+            self.written += count
+            self.batches += 1
+            if self.on_write is not None and written:
+                self.on_write(written)
+            return count
+
+    def _requeue(self, records):
+        # Bounded like pending: past max_pending the oldest are dropped.
+        self._retry.extend(records)
+        excess = len(self._retry) - self.pending.maxlen
+        if excess > 0:
+            del self._retry[:excess]
+            self.dropped += excess
+
+    def _write(self, partition, tables):
+        # Returns ({schema: rows actually written}, {schema: error}). Each group
+        # commits on its own, so a failed one leaves the others written.
+        written = {}
+        failed = {}
+        for schema, rows in tables.items():
+            try:
+                conn = self._open(partition)
+                table = self._table(conn, schema)
+                placeholders = ", ".join("?" * (len(RESERVED_COLUMNS) + len(schema)))
+                written[schema] = self._insert(conn, f"INSERT INTO {table} VALUES ({placeholders})", rows)
+            except Exception as e:
+                self._close()
+                failed[schema] = e
+        if self._conn is not None and self._file_size() >= self.max_file_bytes:
+            self._close()
+            self._seq += 1
+        return written, failed
+
+    def _insert(self, conn, statement, rows):
+        try:
+            with conn:
+                conn.executemany(statement, rows)
+            return rows
+        except ROW_ERRORS:
+            pass
+        # One bad reading must not cost the rest of the group.
+        kept = []
+        rejected = 0
+        with conn:
+            for row in rows:
+                try:
+                    conn.execute(statement, row)
+                    kept.append(row)
+                except ROW_ERRORS:
+                    rejected += 1
+        # Only once committed; a group that fails is counted again on retry.
+        self.rejected += rejected
+        return kept
+
+    def _open(self, partition):
+        if partition != self._partition:
+            self._close()
+            self._partition = partition
+            os.makedirs(self.directory, exist_ok=True)
+            # Continue after files a previous run left for this partition.
+            self._seq = max([seq for start, seq, _ in partition_files(self.directory) if start == partition],
+                            default=0)
+        if self._conn is None:
+            path = partition_path(self.directory, partition, self._seq)
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS schemas (name TEXT PRIMARY KEY, fields TEXT NOT NULL)")
+            self._tables = self._load_tables(self._conn)
+        return self._conn
+
+    def _load_tables(self, conn):
+        return {tuple(json.loads(fields)): name for name, fields in conn.execute("SELECT name, fields FROM schemas")}
+
+    def _table(self, conn, schema):
+        table = self._tables.get(schema)
+        if table is None:
+            columns = ", ".join(["device_id TEXT NOT NULL", "ts REAL", "received REAL NOT NULL"]
+                                + [quote(name) for name in schema])
+            # Committed on its own, so a failed insert cannot roll back a table
+            # this writer already has in its cache. BEGIN IMMEDIATE holds the
+            # write lock while schemas is re-read, so another writer on the same
+            # file either already added this schema or cannot take the name.
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                self._tables = self._load_tables(conn)
+                table = self._tables.get(schema)
+                if table is None:
+                    table = f"readings_{len(self._tables) + 1}"
+                    conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+                    conn.execute("INSERT INTO schemas (name, fields) VALUES (?, ?)", (table, json.dumps(schema)))
+            self._tables[schema] = table
+        return table
+
+    def _file_size(self):
+        path = partition_path(self.directory, self._partition, self._seq)
+        size = 0
+        for suffix in ("", "-wal"):
+            try:
+                size += os.path.getsize(path + suffix)
+            except OSError:
+                pass
+        return size
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            self._tables = {}
+
+
+def open_telemetry_store(enabled=TELEMETRY_STORE, report=print_line):
+    return TelemetryStore(report=report) if enabled else None
@@ -0,0 +1,137 @@
+import collections
+import itertools
+import os
+import sys
+import threading
+import time
+from broker.metrics import Counter
+from config import TRACE_SAMPLE_EVERY, PROFILE_SECONDS, PROFILE_INTERVAL, PROFILE_DIR
+
+# Hot-path instrumentation. A Tracer picks 1 in sample_every messages and
+# times the stages each one goes through; unsampled messages only pay for a
+# None check. A SamplingProfiler snapshots every thread's stack at a fixed
+# interval for a while and writes the counts as collapsed stacks
+# ("thread;module:function;... count" per line), which flamegraph.pl and
+# speedscope read directly.
+
+STAGES = ("parse", "lookup", "checks", "verify", "decode", "commit", "report")
+
+
+class Trace:
+    __slots__ = ("last", "stages")
+
+    def __init__(self):
+        self.last = time.perf_counter()
+        self.stages = []
+
+    def mark(self, stage):
+        # Time since the previous mark (or the start) is charged to stage.
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def add(self, stage, seconds):
+        # For work measured elsewhere, like a verify shared by a whole batch.
+        self.stages.append((stage, seconds))
+        self.last = time.perf_counter()
+
+
+class Tracer:
+    def __init__(self, sample_every=TRACE_SAMPLE_EVERY):
+        self.sample_every = max(1, sample_every)
+        self._counter = itertools.count()
+        self.seconds = Counter("iot_stage_seconds_total", "Time spent per hot-path stage by sampled messages.",
+                               ("stage",))
+        self.samples = Counter("iot_stage_samples_total", "Sampled messages that went through each stage.",
+                               ("stage",))
+        self._reported = ({}, {})
+
+    def start(self):
+        # A Trace for 1 in sample_every calls, None otherwise.
+        if next(self._counter) % self.sample_every:
+            return None
+        return Trace()
+
+    def finish(self, trace):
+        for stage, seconds in trace.stages:
+            self.seconds.inc((stage,), seconds)
+            self.samples.inc((stage,))
+
+    def summary(self):
+        # Mean time per stage since the previous summary, or None without samples.
+        seconds, samples = self.seconds.values(), self.samples.values()
+        last_seconds, last_samples = self._reported
+        self._reported = (seconds, samples)
+        parts = []
+        for (stage,), count in sorted(samples.items(), key=lambda item: _stage_order(item[0][0])):
+            count -= last_samples.get((stage,), 0)
+            if count:
+                mean = (seconds[(stage,)] - last_seconds.get((stage,), 0)) / count
+                parts.append(f"{stage} {mean * 1e6:.0f}µs")
+        if not parts:
+            return None
+        return f"Stage timings (1 in {self.sample_every} messages): " + ", ".join(parts)
+
+
+def _stage_order(stage):
+    return STAGES.index(stage) if stage in STAGES else len(STAGES)
+
+
+class SamplingProfiler:
+    def __init__(self, directory=PROFILE_DIR, interval=PROFILE_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._running = False
+
+    def start(self, seconds=PROFILE_SECONDS, on_done=None):
+        # Returns False if a profile is already being recorded.
+        with self._lock:
+            if self._running:
+                return False
+            self._running = True
+        threading.Thread(target=self._record, args=(seconds, on_done), name="profiler", daemon=True).start()
+        return True
+
+    def _record(self, seconds, on_done):
+        try:
+            path = self.write(self.sample(seconds))
+        finally:
+            with self._lock:
+                self._running = False
+        if on_done is not None:
+            on_done(path)
+
+    def sample(self, seconds):
+        own = threading.get_ident()
+        names = {}
+        stacks = collections.Counter()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stacks[(names.get(ident, str(ident)),) + _frames(frame)] += 1
+            time.sleep(self.interval)
+        return stacks
+
+    def write(self, stacks):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, time.strftime("profile-%Y%m%dT%H%M%S.folded"))
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(";".join(stack) + f" {count}\n")
+        return path
+
+
+def _frames(frame):
+    # Root first, as collapsed stacks expect.
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        names.append(f"{module}:{code.co_name}")
+        frame = frame.f_back
+    return tuple(reversed(names))
@@ -6,4 +6,139 @@ PUBLIC_KEY_DIR = "credentials/identity"
 
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
-TOPIC_PATTERN = "iot/+/data"
+# Device topics end in the device's shard, crc32(device id) % TOPIC_SHARDS, so a
+# partitioned subscriber subscribes only to the shards it owns
+TOPIC_SHARDS = 64
+DATA_TOPIC = "iot/{device_id}/data/{shard}"
+TOPIC_PATTERN = "iot/+/data/+"
+# Unsharded topics from before TOPIC_SHARDS. Still subscribed to so older
+# publishers keep working (partitioned members then drop other members'
+# devices by id hash); set LEGACY_TOPICS = False once nothing uses them
+LEGACY_TOPICS = True
+LEGACY_TOPIC_PATTERN = "iot/+/data"
+LEGACY_SESSION_INIT_PATTERN = "iot/+/session/init"
+# Message transport: "mqtt" (via MQTT_BROKER) or "inproc" (publishers and the
+# subscriber share one process and exchange buffers directly)
+TRANSPORT = "mqtt"
+
+# Broker health: MQTT CONNECT/CONNACK probe every interval, plus $SYS stats if published
+BROKER_HEALTH_INTERVAL = 5
+BROKER_HEALTH_TIMEOUT = 1.0
+BROKER_SYS_STATS = True
+
+# Subscriber ingest pipeline
+VERIFY_WORKERS = 4
+VERIFY_WORKER_KIND = "thread"  # "thread" or "process"
+VERIFY_BATCH_SIZE = 32
+INGEST_QUEUE_SIZE = 10000
+INGEST_OVERFLOW_POLICY = "drop_oldest"  # "drop_oldest", "drop_newest" or "block"
+PIPELINE_STATS_INTERVAL = 10
+REGISTRY_POLL_INTERVAL = 0.2
+
+# Subscriber log: written in batches by a background thread. Once an interval has
+# logged LOG_SAMPLE_AFTER valid results only 1 in LOG_SAMPLE_VALID is written;
+# rejections are always written and each interval ends with per-device counts.
+LOG_FORMAT = "text"  # "text" or "json" (one record per line)
+LOG_SAMPLE_VALID = 100
+LOG_SAMPLE_AFTER = 20
+LOG_SUMMARY_INTERVAL = 10
+LOG_FLUSH_INTERVAL = 0.2
+
+# Prometheus-format metrics at http://METRICS_HOST:METRICS_PORT/metrics (None disables)
+METRICS_PORT = 9108
+METRICS_HOST = "127.0.0.1"
+METRICS_PER_DEVICE = True  # per-device series; turn off for very large fleets
+
+# Subscriber group (python -m broker.cluster): "partitioned" members each subscribe
+# to their own TOPIC_SHARDS and so only see their devices; "shared" uses an MQTT v5 $share group
+# (broker-balanced, no device affinity, so replay windows are per member)
+CLUSTER_MODE = "partitioned"
+CLUSTER_SIZE = None  # None: one subscriber per CPU
+CLUSTER_SHARE_GROUP = "verifiers"
+
+# Wire format used by the simulators: "detached" (signed bytes travel verbatim),
+# "binary" (schema-packed, raw r||s signature) or legacy "json"
+ENVELOPE_FORMAT = "detached"
+
+# Device-side batching: above 1, readings are collected and sent as one batch
+# envelope (Merkle root signed once) per DEVICE_BATCH_SIZE readings or
+# DEVICE_BATCH_WINDOW seconds, whichever comes first
+DEVICE_BATCH_SIZE = 1
+DEVICE_BATCH_WINDOW = 30
+
+# Session mode: one ECDSA-authenticated ECDH handshake, then HMAC-tagged telemetry
+AUTH_MODE = "signature"  # "signature" or "session"
+SESSION_INIT_TOPIC = "iot/{device_id}/session/init/{shard}"
+SESSION_ACK_TOPIC = "iot/{device_id}/session/ack"
+SESSION_INIT_PATTERN = "iot/+/session/init/+"
+SESSION_TTL = 3600
+SESSION_MAX_MESSAGES = 1000000
+SESSION_REKEY_MARGIN = 60
+SESSION_HANDSHAKE_SKEW = 30
+# Out-of-order session counters accepted behind the highest one seen
+SESSION_REPLAY_WINDOW = 64
+
+# Replay protection (checked before signature verification)
+REPLAY_SKEW = 30
+REPLAY_MAX_AGE = 300
+REPLAY_MAX_DEVICES = 100000
+REPLAY_DIGEST_CAPACITY = 100000
+REPLAY_DIGEST_TTL = 600
+
+# Admission control before any signature work: per-device token bucket (ADMISSION_RATE
+# messages/s, bursts up to ADMISSION_BURST; 0 disables), payload size limit, and short
+# bans for unregistered ids and for devices failing ADMISSION_INVALID_LIMIT verifications
+# within ADMISSION_INVALID_WINDOW seconds (0 disables; anyone able to publish on a
+# device's topic can trigger that ban)
+ADMISSION_CONTROL = True
+ADMISSION_RATE = 50
+ADMISSION_BURST = 100
+ADMISSION_MAX_PAYLOAD = 65536
+ADMISSION_MAX_DEVICES = 100000
+ADMISSION_UNREGISTERED_TTL = 30
+ADMISSION_INVALID_LIMIT = 5
+ADMISSION_INVALID_WINDOW = 60
+ADMISSION_BLOCK_SECONDS = 30
+
+# Registry storage backend: "json" (REGISTRY_PATH) or "sqlite" (REGISTRY_DB_PATH)
+REGISTRY_BACKEND = "json"
+REGISTRY_DB_PATH = "credentials/did_registry.db"
+
+# Write new key files into hashed sub-directories of PRIVATE_KEY_DIR / PUBLIC_KEY_DIR
+KEY_DIR_SHARDING = True
+PROVISIONING_WORKERS = None  # None: one worker per CPU
+# Key type for newly registered devices: "ecdsa-p256" or "ed25519". Existing
+# devices keep the algorithm recorded in their registry entry.
+KEY_ALGORITHM = "ecdsa-p256"
+
+# Precompiled, mmap'ed public-key index (python -m utils.key_index rebuilds it)
+USE_KEY_INDEX = False
+KEY_INDEX_PATH = "credentials/public_keys.idx"
+# Most key objects kept materialized at once (LRU); None keeps every key that was used
+KEY_CACHE_SIZE = 50000
+
+# Verified readings are stored in SQLite (WAL) files under TELEMETRY_DIR, one per
+# TELEMETRY_PARTITION_SECONDS, rolling over early past TELEMETRY_MAX_FILE_BYTES
+TELEMETRY_STORE = True
+TELEMETRY_DIR = "telemetry"
+TELEMETRY_PARTITION_SECONDS = 3600
+TELEMETRY_MAX_FILE_BYTES = 256 * 1024 * 1024
+TELEMETRY_FLUSH_INTERVAL = 0.5
+TELEMETRY_MAX_PENDING = 200000
+
+# Live per-device rollups (python -m broker.rollups queries stored files or, with
+# --live, the subscriber's http://METRICS_HOST:METRICS_PORT/rollups)
+ROLLUP_FIELDS = ("temperature", "humidity", "light_intensity", "status")
+ROLLUP_WINDOW = 60
+ROLLUP_PERCENTILES = (50, 95, 99)
+ROLLUP_KEEP_WINDOWS = 60
+
+# Hot-path tracing: per-stage timings for 1 in TRACE_SAMPLE_EVERY messages (0: off),
+# logged every TRACE_REPORT_INTERVAL seconds and exported as iot_stage_seconds_total.
+# SIGUSR1 or GET /profile on the metrics endpoint records a sampling profile for
+# PROFILE_SECONDS into PROFILE_DIR as collapsed stacks (flamegraph.pl, speedscope)
+TRACE_SAMPLE_EVERY = 0
+TRACE_REPORT_INTERVAL = 10
+PROFILE_SECONDS = 10
+PROFILE_INTERVAL = 0.005
+PROFILE_DIR = "profiles"
@@ -1,8 +1,11 @@
-import json
 import time
-import paho.mqtt.client as mqtt
-from utils.crypto_utils import load_private_key, sign_message
-from config import MQTT_BROKER, MQTT_PORT, PRIVATE_KEY_DIR
+from utils.crypto_utils import load_private_key
+from utils.envelope import encode_envelope, data_topic, ReadingBatcher
+from utils.session import DeviceSession
+from utils.key_paths import resolve_private_key_path
+from utils.transport import create_transport, TRANSPORT_INPROC
+from config import ENVELOPE_FORMAT, AUTH_MODE, TRANSPORT, DEVICE_BATCH_SIZE
+from identity_registry import device_index
 import sys
 
 if len(sys.argv) < 2:
@@ -10,10 +13,12 @@ if len(sys.argv) < 2:
     sys.exit(1)
 
 DEVICE_ID = sys.argv[1]
-PRIVATE_KEY_PATH = f"{PRIVATE_KEY_DIR}/{DEVICE_ID}_private.pem"
-TOPIC = f"iot/{DEVICE_ID}/data"
+PRIVATE_KEY_PATH = resolve_private_key_path(DEVICE_ID)
+TOPIC = data_topic(DEVICE_ID)
+DEVICE_INDEX = device_index(DEVICE_ID)
 
-def create_signed_payload(private_key):
+def create_signed_payload(private_key, session=None, batcher=None):
+    # Returns None while a batcher is still collecting readings.
     message = {
         "device_id": DEVICE_ID,
         "timestamp": int(time.time()),
@@ -22,23 +27,50 @@ def create_signed_payload(private_key):
             "humidity": 50 + (hash(DEVICE_ID) % 20)
         }
     }
-    msg_bytes = json.dumps(message).encode()
-    signature = sign_message(private_key, msg_bytes)
-    return {
-        "payload": message,
-        "signature": signature.hex()
-    }
+    if session is not None and session.established():
+        return session.seal(message)
+    if batcher is not None:
+        return batcher.add(message)
+    return encode_envelope(private_key, message, ENVELOPE_FORMAT, DEVICE_INDEX)
+
+def start_session(client, private_key):
+    session = DeviceSession(DEVICE_ID, private_key)
+
+    def on_message(client, userdata, msg):
+        try:
+            if session.accept(msg.payload):
+                print(f"🔑 Session established for {DEVICE_ID}")
+            else:
+                print(f"⚠️ Subscriber no longer knows the session of {DEVICE_ID}; re-handshaking.")
+        except Exception as e:
+            print(f"❌ Session ack ignored: {e}")
+
+    client.on_message = on_message
+    client.subscribe(session.ack_topic, qos=1)
+    return session
 
 def main():
     print(f"📡 {DEVICE_ID} simulator started.")
     private_key = load_private_key(PRIVATE_KEY_PATH)
-    client = mqtt.Client()
-    client.connect(MQTT_BROKER, MQTT_PORT, 60)
+    if TRANSPORT == TRANSPORT_INPROC:
+        # Nobody outside this process can hear an in-process publisher, so the
+        # verifier runs alongside it.
+        from broker import subscriber
+        subscriber.start()
+    client = create_transport(client_id=f"{DEVICE_ID}_sim")
+    client.connect()
+    client.loop_start()
+    if client.connected.wait(10):
+        print(f"🔗 {DEVICE_ID} connected.")
+    session = start_session(client, private_key) if AUTH_MODE == "session" else None
+    batcher = ReadingBatcher(private_key) if DEVICE_BATCH_SIZE > 1 and session is None else None
     while True:
-        signed_payload = create_signed_payload(private_key)
-        message_json = json.dumps(signed_payload)
-        client.publish(TOPIC, message_json)
-        print(f"✅ Sent signed message from {DEVICE_ID} to {TOPIC}")
+        if session is not None and session.needs_rekey():
+            client.publish(session.init_topic, session.handshake_message(), qos=1)
+        signed = create_signed_payload(private_key, session, batcher)
+        if signed is not None:
+            client.publish(TOPIC, signed)
+            print(f"✅ Sent signed message from {DEVICE_ID} to {TOPIC}")
         time.sleep(5)
 
 if __name__ == "__main__":
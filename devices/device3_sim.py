@@ -1,24 +1,30 @@
 import time
-import json
-import paho.mqtt.client as mqtt
 import random
 import os
 import threading
-from utils.crypto_utils import sign_message, load_private_key_from_file
+from utils.crypto_utils import load_private_key_from_file
+from utils.envelope import encode_envelope, data_topic, ReadingBatcher
+from utils.key_paths import resolve_private_key_path
+from utils.registry_store import open_registry_store
+from config import ENVELOPE_FORMAT, PRIVATE_KEY_DIR, DEVICE_BATCH_SIZE
+from identity_registry import device_index
+from utils.transport import MqttTransport
 
 # MQTT configuration
 BROKER = "localhost"
 PORT = 1883
-TOPIC = "device3/data"
+TOPIC = data_topic("device3")
 START_TOPIC = "system/start_signal"
 
 # Load private key for signing
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-PRIVATE_KEY_PATH = os.path.join(BASE_DIR, "credentials", "private_keys", "device3_private.pem")
+PRIVATE_KEY_PATH = resolve_private_key_path("device3", os.path.join(BASE_DIR, PRIVATE_KEY_DIR))
 private_key = load_private_key_from_file(PRIVATE_KEY_PATH)
+DEVICE_INDEX = device_index("device3", open_registry_store(base_dir=BASE_DIR))
+batcher = ReadingBatcher(private_key) if DEVICE_BATCH_SIZE > 1 else None
 
-# Initialize MQTT client
-client = mqtt.Client(client_id="device3_sim", callback_api_version=2)
+# Initialize MQTT client (the GUI runs each device as its own process)
+client = MqttTransport("device3_sim", BROKER, PORT)
 
 start_received_event = threading.Event()
 stop_received_event = threading.Event()
@@ -47,20 +53,17 @@ def publish_data():
         "timestamp": int(time.time())
     }
 
-    message_bytes = json.dumps(payload).encode()
-    signature = sign_message(private_key, message_bytes).hex()
-
-    signed_message = {
-        "payload": payload,
-        "signature": signature
-    }
-
-    client.publish(TOPIC, json.dumps(signed_message))
-    print(f"=>Sent: {signed_message}", flush=True)
+    if batcher is not None:
+        signed = batcher.add(payload)
+        if signed is not None:
+            client.publish(TOPIC, signed)
+    else:
+        client.publish(TOPIC, encode_envelope(private_key, payload, ENVELOPE_FORMAT, DEVICE_INDEX))
+    print(f"=>Sent: {payload}", flush=True)
 
 def main():
     client.on_message = on_message
-    client.connect(BROKER, PORT)
+    client.connect()
     client.subscribe(START_TOPIC)
     client.loop_start()
 
@@ -85,6 +88,11 @@ def main():
         print("Device3 simulator stopped by user.", flush=True)
     finally:
         print("=> Shutting down Device3 simulator.", flush=True)
+        if batcher is not None and client.connected.is_set():
+            # Send the readings collected so far instead of dropping them.
+            signed = batcher.flush()
+            if signed is not None:
+                client.publish(TOPIC, signed).wait_for_publish(1)
         client.loop_stop()
         client.disconnect()
 
@@ -0,0 +1,291 @@
+import argparse
+import asyncio
+import functools
+import math
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from utils.crypto_utils import load_private_key
+from utils.envelope import encode_envelope, data_topic, ENVELOPE_FORMATS
+from utils.key_paths import resolve_private_key_path
+from identity_registry import load_registry
+from utils.transport import create_transport, TRANSPORT_MQTT, TRANSPORT_INPROC
+from config import ENVELOPE_FORMAT, TRANSPORT
+
+print = functools.partial(print, flush=True)
+
+START_TOPIC = "system/start_signal"
+MODELS = ("climate", "light", "motion")
+TICK = 0.05
+
+
+class SensorModels:
+    # Holds per-device sensor state as arrays so a whole tick of readings is
+    # produced with a handful of vector operations.
+    def __init__(self, models, rng):
+        self.rng = rng
+        self.models = np.asarray(models)
+        n = len(models)
+        self.temperature = rng.uniform(20.0, 30.0, n)
+        self.humidity = rng.uniform(30.0, 60.0, n)
+        self.light = rng.uniform(100.0, 800.0, n)
+        self.sensitivity = rng.integers(1, 6, n)
+
+    def readings(self, due, now):
+        timestamp = int(now)
+        rng = self.rng
+        n = len(due)
+        self.temperature[due] = np.clip(self.temperature[due] + rng.normal(0, 0.2, n), 20.0, 30.0)
+        self.humidity[due] = np.clip(self.humidity[due] + rng.normal(0, 0.5, n), 30.0, 60.0)
+        self.light[due] = np.clip(self.light[due] + rng.normal(0, 15.0, n), 100.0, 800.0)
+        temperature = np.round(self.temperature[due], 2).tolist()
+        humidity = np.round(self.humidity[due], 2).tolist()
+        light = np.round(self.light[due], 2).tolist()
+        status = (rng.random(n) < 0.5).tolist()
+        motion = (rng.random(n) < 0.1).tolist()
+        sensitivity = self.sensitivity[due].tolist()
+        models = self.models[due].tolist()
+
+        readings = []
+        for i, model in enumerate(models):
+            if model == "climate":
+                fields = {"temperature": temperature[i], "humidity": humidity[i]}
+            elif model == "light":
+                fields = {"light_intensity": light[i], "status": "ON" if status[i] else "OFF"}
+            else:
+                fields = {"motion_detected": motion[i], "sensitivity_level": sensitivity[i]}
+            fields["timestamp"] = timestamp
+            readings.append(fields)
+        return readings
+
+
+_signing_keys = {}
+
+def sign_chunk(items, fmt):
+    # Runs in the signing worker processes; each process loads a device's key once.
+    messages = []
+    for device_id, device_index, reading in items:
+        private_key = _signing_keys.get(device_id)
+        if private_key is None:
+            private_key = load_private_key(resolve_private_key_path(device_id))
+            _signing_keys[device_id] = private_key
+        payload = {"device_id": device_id, **reading}
+        messages.append((data_topic(device_id), encode_envelope(private_key, payload, fmt, device_index)))
+    return messages
+
+
+def positive_rate(value):
+    rate = float(value)
+    if not (rate > 0 and math.isfinite(rate)):
+        raise argparse.ArgumentTypeError(f"rate must be a positive number: {value}")
+    return rate
+
+
+def parse_model_rates(specs):
+    # ["motion=2", "climate=0.1"] -> {"motion": 2.0, "climate": 0.1}
+    rates = {}
+    for spec in specs or []:
+        model, _, rate = spec.partition("=")
+        if model not in MODELS or not rate:
+            raise argparse.ArgumentTypeError(f"expected MODEL=RATE with MODEL one of {', '.join(MODELS)}: {spec}")
+        try:
+            rates[model] = positive_rate(rate)
+        except (argparse.ArgumentTypeError, ValueError) as e:
+            raise argparse.ArgumentTypeError(f"{spec}: {e}")
+    return rates
+
+
+class Fleet:
+    # Each device sends at its own rate: its model's rate (or the fleet-wide
+    # one), times a lognormal factor with median 1 when rate_spread is set, so
+    # a few devices are much chattier than the rest, as in real fleets.
+    def __init__(self, device_ids, models, rate, jitter, connections, signers, fmt, chunk_size, seed=None,
+                 transport=TRANSPORT, rate_spread=0.0, model_rates=None):
+        self.device_ids = device_ids
+        self.jitter = jitter
+        self.fmt = fmt
+        self.chunk_size = chunk_size
+        self.transport = transport
+        self.rng = np.random.default_rng(seed)
+        self.sensors = SensorModels(models, self.rng)
+        registry = load_registry()
+        self.device_indexes = [registry.get(device_id, {}).get("index") for device_id in device_ids]
+        n = len(device_ids)
+        model_rates = model_rates or {}
+        self.rates = np.array([model_rates.get(model, rate) for model in models], dtype=float)
+        if rate_spread:
+            self.rates *= self.rng.lognormal(0.0, rate_spread, n)
+        self.interval = 1.0 / self.rates
+        self.next_due = time.time() + self.rng.uniform(0, 1, n) * self.interval
+        self.pool = ProcessPoolExecutor(max_workers=signers)
+        self.max_in_flight = signers * 2
+        self.clients = [self._client(i) for i in range(connections)]
+        self.start_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.sent = 0
+        self.skipped = 0
+
+    def _client(self, number):
+        return create_transport(self.transport, client_id=f"fleet_sim_{os.getpid()}_{number}")
+
+    def on_control(self, client, userdata, msg):
+        payload = msg.payload.decode()
+        if payload == "start":
+            if msg.retain:
+                print("[INFO] Ignored retained start signal.")
+                return
+            if not self.start_event.is_set():
+                print("[INFO] Start signal received. Beginning data transmission...")
+                self.start_event.set()
+        elif payload == "stop":
+            print("[INFO] Stop signal received. Halting transmission...")
+            self.stop_event.set()
+
+    def connect(self):
+        for client in self.clients:
+            client.connect()
+            client.loop_start()
+        control = self.clients[0]
+        control.on_message = self.on_control
+        control.subscribe(START_TOPIC)
+
+    def disconnect(self):
+        for client in self.clients:
+            client.loop_stop()
+            client.disconnect()
+        self.pool.shutdown(cancel_futures=True)
+
+    def publish(self, messages, offset):
+        clients = self.clients
+        for i, (topic, payload) in enumerate(messages):
+            clients[(offset + i) % len(clients)].publish(topic, payload)
+        self.sent += len(messages)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        in_flight = set()
+        last_report = time.time()
+        last_sent = 0
+        while not self.stop_event.is_set():
+            now = time.time()
+            due = np.flatnonzero(self.next_due <= now)
+            if len(due):
+                spread = 1 + self.jitter * self.rng.uniform(-1, 1, len(due))
+                self.next_due[due] = np.maximum(self.next_due[due] + self.interval[due] * spread, now)
+                readings = self.sensors.readings(due, now)
+                items = [(self.device_ids[d], self.device_indexes[d], r) for d, r in zip(due.tolist(), readings)]
+                for start in range(0, len(items), self.chunk_size):
+                    if len(in_flight) >= self.max_in_flight:
+                        # Signers cannot keep up; drop this tick's remainder rather than queue it.
+                        self.skipped += len(items) - start
+                        break
+                    chunk = items[start:start + self.chunk_size]
+                    future = loop.run_in_executor(self.pool, sign_chunk, chunk, self.fmt)
+                    future.add_done_callback(functools.partial(self._signed, offset=start))
+                    in_flight.add(future)
+                    future.add_done_callback(in_flight.discard)
+
+            if now - last_report >= 5:
+                rate = (self.sent - last_sent) / (now - last_report)
+                print(f"[INFO] {rate:.0f} msg/s across {len(self.device_ids)} devices "
+                      f"({self.skipped} skipped, {len(in_flight)} batches signing)")
+                last_report, last_sent = now, self.sent
+            await asyncio.sleep(TICK)
+
+        if in_flight:
+            await asyncio.wait(in_flight, timeout=5)
+
+    def _signed(self, future, offset):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            print(f"[ERROR] Signing failed: {error}")
+            return
+        self.publish(future.result(), offset)
+
+
+def parse_device_ids(args):
+    device_ids = list(args.device_ids)
+    if args.count:
+        device_ids.extend(f"{args.prefix}{n}" for n in range(args.start, args.start + args.count))
+    if args.ids_file:
+        with open(args.ids_file) as f:
+            device_ids.extend(line.strip() for line in f if line.strip())
+    return device_ids
+
+
+def assign_models(device_ids, model):
+    if model != "mixed":
+        return [model] * len(device_ids)
+    return [MODELS[i % len(MODELS)] for i in range(len(device_ids))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many devices from one process.")
+    parser.add_argument("device_ids", nargs="*", help="registered device ids to simulate")
+    parser.add_argument("--count", type=int, help="simulate COUNT devices named <prefix><n>")
+    parser.add_argument("--prefix", default="device")
+    parser.add_argument("--start", type=int, default=1)
+    parser.add_argument("--ids-file", metavar="PATH")
+    parser.add_argument("--model", choices=MODELS + ("mixed",), default="mixed", help="sensor model per device")
+    parser.add_argument("--rate", type=positive_rate, default=1 / 3, help="messages per second per device")
+    parser.add_argument("--model-rate", action="append", metavar="MODEL=RATE",
+                        help="messages per second for devices of one model (repeatable)")
+    parser.add_argument("--rate-spread", type=float, default=0.0,
+                        help="sigma of a lognormal spread of per-device rates around their median")
+    parser.add_argument("--jitter", type=float, default=0.2, help="relative jitter on the send interval")
+    parser.add_argument("--connections", type=int, default=4, help="MQTT connections shared by all devices")
+    parser.add_argument("--signers", type=int, default=os.cpu_count(), help="signing worker processes")
+    parser.add_argument("--chunk-size", type=int, default=256, help="readings per signing job")
+    parser.add_argument("--format", choices=ENVELOPE_FORMATS, default=ENVELOPE_FORMAT)
+    parser.add_argument("--transport", choices=(TRANSPORT_MQTT, TRANSPORT_INPROC), default=TRANSPORT,
+                        help="inproc runs the subscriber inside this process instead of going through the broker")
+    parser.add_argument("--no-wait", action="store_true", help="start publishing without waiting for a start signal")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    device_ids = parse_device_ids(args)
+    if not device_ids:
+        print("Usage: python fleet_sim.py --count N [--prefix device] | <device_id> ...")
+        sys.exit(1)
+    try:
+        model_rates = parse_model_rates(args.model_rate)
+    except (argparse.ArgumentTypeError, ValueError) as e:
+        parser.error(str(e))
+
+    if args.transport == TRANSPORT_INPROC:
+        from broker import subscriber
+        subscriber.start(create_transport(TRANSPORT_INPROC, client_id="subscriber"))
+    fleet = Fleet(device_ids, assign_models(device_ids, args.model), args.rate, args.jitter,
+                  max(1, args.connections), max(1, args.signers), args.format, args.chunk_size, args.seed,
+                  args.transport, args.rate_spread, model_rates)
+    low, median, high = np.percentile(fleet.rates, (0, 50, 100))
+    print(f"📡 Fleet simulator: {len(device_ids)} devices, {len(fleet.clients)} connections, "
+          f"{args.signers} signers, {fleet.rates.sum():.1f} msg/s in total.")
+    print(f"   Per-device rate: min {low:.3g}, median {median:.3g}, max {high:.3g} msg/s.")
+    fleet.connect()
+
+    if args.no_wait:
+        fleet.start_event.set()
+    else:
+        print("[WAIT] Waiting for start signal...")
+    while not fleet.start_event.is_set() and not fleet.stop_event.is_set():
+        time.sleep(0.5)
+
+    try:
+        if not fleet.stop_event.is_set():
+            print("[OK] Start signal confirmed. Publishing will now begin.")
+            asyncio.run(fleet.run())
+    except KeyboardInterrupt:
+        print("Fleet simulator stopped by user.")
+    finally:
+        print(f"=> Shutting down fleet simulator ({fleet.sent} messages sent).")
+        fleet.disconnect()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,205 @@
 import os
-import json
 import sys
-from utils.crypto_utils import generate_keys, serialize_public_key, serialize_private_key
-from config import REGISTRY_PATH, PRIVATE_KEY_DIR, PUBLIC_KEY_DIR
+import time
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from utils.crypto_utils import generate_keys, serialize_public_key, serialize_private_key, KEY_ALGORITHMS
+from utils.registry_store import open_registry_store, RegistryError
+from utils.key_paths import private_key_path, public_key_path
+from utils.key_index import rebuild_from_registry
+from config import PROVISIONING_WORKERS, USE_KEY_INDEX, KEY_ALGORITHM
+
+_store = None
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = open_registry_store()
+    return _store
+
+def registry_changed():
+    if USE_KEY_INDEX:
+        rebuild_from_registry()
 
 def load_registry():
-    if not os.path.exists(REGISTRY_PATH):
+    try:
+        return get_store().load()
+    except RegistryError:
         return {}
-    with open(REGISTRY_PATH, "r") as f:
-        try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            return {}
 
-def register_device(device_id):
-    if not device_id.strip():
-        return False, "Device ID cannot be empty"
+def device_index(device_id, store=None):
+    entry = (store or get_store()).get(device_id)
+    return entry.get("index") if entry else None
 
-    registry = load_registry()
-    if device_id in registry:
-        return False, "Device already registered"
+_created_dirs = set()
 
-    private_key, public_key = generate_keys()
-    priv_pem = serialize_private_key(private_key)
-    pub_pem = serialize_public_key(public_key)
+def _write(path, data):
+    directory = os.path.dirname(path)
+    if directory not in _created_dirs:
+        os.makedirs(directory, exist_ok=True)
+        _created_dirs.add(directory)
+    with open(path, "w") as f:
+        f.write(data)
 
-    registry[device_id] = {"public_key": pub_pem}
+def write_key_files(device_id, priv_pem, pub_pem, suffix=""):
+    _write(private_key_path(device_id) + suffix, priv_pem)
+    _write(public_key_path(device_id) + suffix, pub_pem)
 
-    os.makedirs(os.path.dirname(REGISTRY_PATH), exist_ok=True)
-    os.makedirs(PRIVATE_KEY_DIR, exist_ok=True)
-    os.makedirs(PUBLIC_KEY_DIR, exist_ok=True)
+# New key files are written under a staging suffix and only moved into place
+# once the registry has committed the devices, so losing a registration race
+# never overwrites the keys of the device that won it.
+def staging_suffix():
+    return f".staged-{os.getpid()}"
 
-    with open(REGISTRY_PATH, "w") as f:
-        json.dump(registry, f, indent=2)
+def publish_key_files(device_ids, suffix):
+    for device_id in device_ids:
+        for path in (private_key_path(device_id), public_key_path(device_id)):
+            os.replace(path + suffix, path)
 
-    priv_path = os.path.join(PRIVATE_KEY_DIR, f"{device_id}_private.pem")
-    pub_path = os.path.join(PUBLIC_KEY_DIR, f"{device_id}_public_key.pem")
+def discard_key_files(device_ids, suffix):
+    for device_id in device_ids:
+        for path in (private_key_path(device_id), public_key_path(device_id)):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
 
-    with open(priv_path, "w") as f:
-        f.write(priv_pem)
-    with open(pub_path, "w") as f:
-        f.write(pub_pem)
+def provision_keys(device_ids, algorithm=KEY_ALGORITHM, suffix=""):
+    # Runs in the provisioning worker processes.
+    entries = []
+    for device_id in device_ids:
+        private_key, public_key = generate_keys(algorithm)
+        pub_pem = serialize_public_key(public_key)
+        write_key_files(device_id, serialize_private_key(private_key), pub_pem, suffix)
+        entries.append((device_id, pub_pem))
+    return entries
 
-    return True, f"Device '{device_id}' registered."
+def register_devices(device_ids, algorithm=KEY_ALGORITHM):
+    store = get_store()
+    existing = store.registered(device_ids)
+    suffix = staging_suffix()
+    results = {}
+    entries = {}
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python identity_registry.py <device_id>")
+    for device_id in device_ids:
+        if not device_id.strip():
+            results[device_id] = (False, "Device ID cannot be empty")
+        elif device_id in entries or device_id in existing:
+            results[device_id] = (False, "Device already registered")
+        else:
+            private_key, public_key = generate_keys(algorithm)
+            pub_pem = serialize_public_key(public_key)
+            write_key_files(device_id, serialize_private_key(private_key), pub_pem, suffix)
+            entries[device_id] = {"public_key": pub_pem, "algorithm": algorithm}
+
+    if entries:
+        try:
+            store.add_many(entries)
+        except RegistryError as e:
+            # Someone else registered one of them since the check above.
+            discard_key_files(entries, suffix)
+            for device_id in entries:
+                results[device_id] = (False, str(e))
+            return results
+        publish_key_files(entries, suffix)
+        registry_changed()
+        for device_id in entries:
+            results[device_id] = (True, f"Device '{device_id}' registered.")
+    return results
+
+def provision_fleet(device_ids, workers=PROVISIONING_WORKERS, chunk_size=500, algorithm=KEY_ALGORITHM):
+    store = get_store()
+    existing = store.registered(device_ids)
+    suffix = staging_suffix()
+    seen = set()
+    pending = []
+    skipped = 0
+    for device_id in device_ids:
+        if not device_id.strip() or device_id in existing or device_id in seen:
+            skipped += 1
+            continue
+        seen.add(device_id)
+        pending.append(device_id)
+
+    started = time.perf_counter()
+    chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+    entries = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for chunk_entries in pool.map(functools.partial(provision_keys, algorithm=algorithm, suffix=suffix), chunks):
+            for device_id, pub_pem in chunk_entries:
+                entries[device_id] = {"public_key": pub_pem, "algorithm": algorithm}
+    keys_elapsed = time.perf_counter() - started
+
+    if entries:
+        try:
+            store.add_many(entries)
+        except RegistryError:
+            discard_key_files(entries, suffix)
+            raise
+        publish_key_files(entries, suffix)
+        registry_changed()
+    elapsed = time.perf_counter() - started
+    return len(entries), skipped, keys_elapsed, elapsed
+
+def register_device(device_id, algorithm=KEY_ALGORITHM):
+    try:
+        return register_devices([device_id], algorithm)[device_id]
+    except RegistryError as e:
+        return False, str(e)
+
+def main():
+    parser = argparse.ArgumentParser(description="Register devices in the identity registry.")
+    parser.add_argument("device_ids", nargs="*", help="device ids to register")
+    parser.add_argument("--count", type=int, help="bulk-provision COUNT devices named <prefix><n>")
+    parser.add_argument("--prefix", default="device", help="id prefix used with --count")
+    parser.add_argument("--start", type=int, default=1, help="first number used with --count")
+    parser.add_argument("--ids-file", metavar="PATH", help="bulk-provision the ids listed in PATH, one per line")
+    parser.add_argument("--workers", type=int, default=PROVISIONING_WORKERS, help="key generation processes")
+    parser.add_argument("--algorithm", choices=KEY_ALGORITHMS, default=KEY_ALGORITHM, help="key type for new devices")
+    parser.add_argument("--import-json", metavar="PATH", help="replace the registry with a JSON export")
+    parser.add_argument("--export-json", metavar="PATH", help="write the registry as JSON")
+    args = parser.parse_args()
+
+    if not (args.device_ids or args.count or args.ids_file or args.import_json or args.export_json):
+        print("Usage: python identity_registry.py <device_id> [<device_id> ...]")
+        print("       python identity_registry.py --count N [--prefix device] [--workers W]")
         sys.exit(1)
 
-    device_id = sys.argv[1]
-    success, message = register_device(device_id)
-    if success:
-        print("✅", message)
-    else:
-        print("❌", message)
+    store = get_store()
+    if args.import_json:
+        count = store.import_json(args.import_json)
+        registry_changed()
+        print(f"✅ Imported {count} devices into the {store.name} registry.")
+
+    if args.device_ids:
+        try:
+            results = register_devices(args.device_ids, args.algorithm)
+        except RegistryError as e:
+            print("❌", e)
+            sys.exit(1)
+        for device_id, (success, message) in results.items():
+            print("✅" if success else "❌", message if success else f"{device_id}: {message}")
+
+    bulk_ids = []
+    if args.count:
+        bulk_ids.extend(f"{args.prefix}{n}" for n in range(args.start, args.start + args.count))
+    if args.ids_file:
+        with open(args.ids_file) as f:
+            bulk_ids.extend(line.strip() for line in f if line.strip())
+    if bulk_ids:
+        print(f"🔐 Provisioning {len(bulk_ids)} devices...")
+        try:
+            registered, skipped, keys_elapsed, elapsed = provision_fleet(bulk_ids, args.workers, algorithm=args.algorithm)
+        except RegistryError as e:
+            print("❌", e)
+            sys.exit(1)
+        rate = registered / keys_elapsed if keys_elapsed else 0
+        print(f"✅ Registered {registered} devices ({skipped} skipped) in {elapsed:.1f}s, {rate:.0f} keys/sec.")
+
+    if args.export_json:
+        count = store.export_json(args.export_json)
+        print(f"✅ Exported {count} devices to {args.export_json}.")
+
+if __name__ == "__main__":
+    main()
@@ -5,9 +5,10 @@ import threading
 import platform
 import sys
 import os
-from utils.system_utils import check_mosquitto_running
+from collections import deque
+from utils.system_utils import BrokerHealthMonitor
 import time
-import paho.mqtt.publish as publish
+from utils.transport import publish_single, TRANSPORT_MQTT
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 BROKER_CONF = os.path.join(BASE_DIR, "broker", "mosquitto.conf")
@@ -18,6 +19,24 @@ DEVICE_SCRIPTS = {
 }
 SUBSCRIBER_SCRIPT = os.path.join(BASE_DIR, "broker", "subscriber.py")
 
+# Log view: lines are queued by the reader threads and inserted in batches
+LOG_FLUSH_MS = 100
+MAX_LOG_LINES = 5000
+MAX_PENDING_LOG_LINES = 20000
+RATE_WINDOW = 1.0
+LOG_TAGS = {
+    "[device1]": {"foreground": "blue"},
+    "[device2]": {"foreground": "green"},
+    "[device3]": {"foreground": "purple"},
+    "[WAIT]": {"foreground": "orange"},
+    "[INFO]": {"foreground": "teal"},
+    "[OK]": {"foreground": "darkgreen"},
+    "[WARN]": {"foreground": "red"},
+    "[ERROR]": {"foreground": "red", "font": ("Consolas", 10, "bold")},
+    "[Subscriber]": {"foreground": "darkblue"},
+}
+LEVEL_TAGS = ("[WAIT]", "[INFO]", "[OK]", "[WARN]", "[ERROR]")
+
 
 class IoTManagerGUI(tk.Tk):
     def __init__(self):
@@ -29,38 +48,59 @@ class IoTManagerGUI(tk.Tk):
         self.subscriber_process = None
 
         self.broker_status_var = tk.StringVar(value="Broker status: Unknown")
+        self.broker_stats_var = tk.StringVar(value="")
+        self.log_rate_var = tk.StringVar(value="")
+        self.pending_logs = deque(maxlen=MAX_PENDING_LOG_LINES)
+        self.dropped_logs = 0
+        self.log_counts = {}
+        self.log_window_start = time.time()
         self.create_widgets()
         self.start_broker_status_monitor()
+        self.after(LOG_FLUSH_MS, self.flush_logs)
 
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
 
-    def update_broker_status(self):
-        status = "Running" if check_mosquitto_running() else "Not Running"
-        self.after(0, lambda: self.broker_status_var.set(f"Broker status: {status}"))
+    def update_broker_status(self, status):
+        # Called from the health monitor thread whenever the status changes.
+        self.after(0, lambda: self._show_broker_status(status))
+
+    def _show_broker_status(self, status):
+        if status.running:
+            text = "Running" if status.detail == "accepting connections" else f"Running ({status.detail})"
+            if status.latency is not None:
+                text += f", {status.latency * 1000:.0f} ms"
+        else:
+            text = f"Not Running ({status.detail})"
+        self.broker_status_var.set(f"Broker status: {text}")
+        stats = status.stats
+        if status.running and stats:
+            self.broker_stats_var.set(
+                f"{stats.get('clients', 0):.0f} clients, {stats.get('subscriptions', 0):.0f} subscriptions, "
+                f"{stats.get('received_per_min', 0):.0f} msgs/min in, {stats.get('sent_per_min', 0):.0f} msgs/min out")
+        else:
+            self.broker_stats_var.set("")
 
     def start_broker_status_monitor(self):
-        def monitor():
-            while True:
-                self.update_broker_status()
-                time.sleep(5)
-        threading.Thread(target=monitor, daemon=True).start()
+        self.broker_health = BrokerHealthMonitor(on_change=self.update_broker_status)
+        self.broker_health.start()
 
     def send_start_signal(self):
         try:
-            publish.single("system/start_signal", payload="start", qos=1, retain=True, hostname="localhost", port=1883)
+            publish_single("system/start_signal", payload="start", qos=1, retain=True, kind=TRANSPORT_MQTT)
             self.log("[INFO] Start signal sent.")
         except Exception as e:
             self.log(f"[ERROR] Failed to send start signal: {e}")
 
     def send_stop_signal(self):
         try:
-            publish.single("system/start_signal", payload="stop", qos=1, retain=False, hostname="localhost", port=1883)
+            publish_single("system/start_signal", payload="stop", qos=1, retain=False, kind=TRANSPORT_MQTT)
             self.log("[INFO] Stop signal sent.")
         except Exception as e:
             self.log(f"[ERROR] Failed to send stop signal: {e}")
 
     def create_widgets(self):
-        tk.Label(self, textvariable=self.broker_status_var, font=("Arial", 14)).pack(pady=10)
+        tk.Label(self, textvariable=self.broker_status_var, font=("Arial", 14)).pack(pady=(10, 0))
+        tk.Label(self, textvariable=self.broker_stats_var).pack(pady=(0, 10))
 
         broker_frame = tk.Frame(self)
         broker_frame.pack(pady=5)
@@ -90,32 +130,14 @@ class IoTManagerGUI(tk.Tk):
 
         self.log_area = scrolledtext.ScrolledText(subscriber_frame, state='disabled', height=20)
         self.log_area.pack(fill=tk.BOTH, expand=True)
+        tk.Label(subscriber_frame, textvariable=self.log_rate_var, anchor="w").pack(fill=tk.X)
 
-        tag_styles = {
-            "[device1]": {"foreground": "blue"},
-            "[device2]": {"foreground": "green"},
-            "[device3]": {"foreground": "purple"},
-            "[WAIT]": {"foreground": "orange"},
-            "[INFO]": {"foreground": "teal"},
-            "[OK]": {"foreground": "darkgreen"},
-            "[WARN]": {"foreground": "red"},
-            "[ERROR]": {"foreground": "red", "font": ("Consolas", 10, "bold")},
-            "[Subscriber]": {"foreground": "darkblue"},
-        }
-        for tag, config in tag_styles.items():
+        for tag, config in LOG_TAGS.items():
             self.log_area.tag_config(tag, **config)
 
     def check_broker_status(self):
-        def check():
-            if platform.system() == "Windows":
-                result = subprocess.run("sc query mosquitto", capture_output=True, text=True, shell=True)
-                status = "Mosquitto broker is RUNNING" if "RUNNING" in result.stdout else "Mosquitto broker is NOT running"
-            else:
-                result = subprocess.run(["systemctl", "is-active", "mosquitto"], capture_output=True, text=True)
-                status = "Mosquitto broker is RUNNING" if result.returncode == 0 else "Mosquitto broker is NOT running"
-            self.after(0, lambda: self.broker_status_var.set(f"Broker status: {status}"))
-
-        threading.Thread(target=check, daemon=True).start()
+        self.broker_status_var.set("Broker status: Checking...")
+        self.broker_health.refresh(force=True)
 
     def start_broker(self):
         if platform.system() == "Windows":
@@ -123,7 +145,7 @@ class IoTManagerGUI(tk.Tk):
             return
         def start():
             subprocess.run(["sudo", "systemctl", "start", "mosquitto"])
-            self.check_broker_status()
+            self.broker_health.refresh(force=True)
         threading.Thread(target=start, daemon=True).start()
 
     def stop_broker(self):
@@ -132,7 +154,7 @@ class IoTManagerGUI(tk.Tk):
             return
         def stop():
             subprocess.run(["sudo", "systemctl", "stop", "mosquitto"])
-            self.check_broker_status()
+            self.broker_health.refresh(force=True)
         threading.Thread(target=stop, daemon=True).start()
 
     def start_device(self, device_name):
@@ -191,29 +213,81 @@ class IoTManagerGUI(tk.Tk):
         self.log_area.configure(state='disabled')
 
     def log(self, message):
-        self.log_area.configure(state='normal')
-        index_start = self.log_area.index('end-1c')
-        self.log_area.insert(tk.END, message + "\n")
-        index_end = self.log_area.index('end-1c')
-
-        for tag in ["[device1]", "[device2]", "[device3]", "[WAIT]", "[INFO]", "[OK]", "[WARN]", "[ERROR]", "[Subscriber]"]:
-            tag_start = self.log_area.search(tag, index_start, index_end)
-            if tag_start:
-                tag_end = f"{tag_start}+{len(tag)}c"
-                self.log_area.tag_add(tag, tag_start, tag_end)
+        # Safe from any thread; the Tk thread picks lines up in flush_logs.
+        if len(self.pending_logs) == MAX_PENDING_LOG_LINES:
+            self.dropped_logs += 1
+        self.pending_logs.append(message)
 
-        self.log_area.see(tk.END)
+    def flush_logs(self):
+        try:
+            self._insert_pending_logs()
+            self._update_log_rates()
+        finally:
+            self.after(LOG_FLUSH_MS, self.flush_logs)
+
+    def _insert_pending_logs(self):
+        lines = []
+        while self.pending_logs:
+            lines.append(self.pending_logs.popleft())
+        if not lines:
+            return
+        # Lines beyond the retained window are counted but never inserted.
+        skip = len(lines) - MAX_LOG_LINES
+
+        chunks = []
+        counts = self.log_counts
+        for n, line in enumerate(lines):
+            source, rest = split_log_tag(line)
+            if n < skip:
+                key = None if source in LEVEL_TAGS else source
+                counts[key] = counts.get(key, 0) + 1
+                continue
+            if source in LEVEL_TAGS:
+                source, level = None, source
+            elif source and rest.startswith(" ["):
+                level, rest = split_log_tag(rest[1:])
+                chunks += [source, source, " ", ()]
+            else:
+                level = None
+                if source:
+                    chunks += [source, source]
+            counts[source] = counts.get(source, 0) + 1
+            if level:
+                chunks += [level, level]
+            chunks += [rest + "\n", ()]
+
+        at_bottom = self.log_area.yview()[1] >= 0.999
+        self.log_area.configure(state='normal')
+        self.log_area.insert(tk.END, *chunks)
+        excess = int(self.log_area.index('end-1c').split('.')[0]) - 1 - MAX_LOG_LINES
+        if excess > 0:
+            self.log_area.delete('1.0', f"{excess + 1}.0")
         self.log_area.configure(state='disabled')
+        if at_bottom:
+            self.log_area.see(tk.END)
+
+    def _update_log_rates(self):
+        elapsed = time.time() - self.log_window_start
+        if elapsed < RATE_WINDOW:
+            return
+        rates = sorted(self.log_counts.items(), key=lambda item: -item[1])
+        summary = "  ".join(f"{source or '[GUI]'} {count / elapsed:.0f}/s" for source, count in rates[:8])
+        if self.dropped_logs:
+            summary += f"  ({self.dropped_logs} lines dropped)"
+        self.log_rate_var.set(summary)
+        self.log_counts = {}
+        self.log_window_start = time.time()
 
     def _read_process_output(self, process, name):
         def stream_output():
             for line in iter(process.stdout.readline, ''):
                 if line:
-                    self.after(0, lambda l=line: self.log(f"[{name}] {l.strip()}"))
+                    self.log(f"[{name}] {line.strip()}")
             process.stdout.close()
         threading.Thread(target=stream_output, daemon=True).start()
 
     def on_closing(self):
+        self.broker_health.stop()
         for process in self.device_processes.values():
             if process and process.poll() is None:
                 process.terminate()
@@ -222,14 +296,23 @@ class IoTManagerGUI(tk.Tk):
         self.destroy()
 
 
+def split_log_tag(line):
+    # "[name] rest" -> ("[name]", " rest"); lines without a prefix -> (None, line)
+    if line.startswith("["):
+        end = line.find("]")
+        if end > 0:
+            return line[:end + 1], line[end + 1:]
+    return None, line
+
+
 def clear_retained_start_signal():
     try:
-        publish.single(
+        publish_single(
             topic="system/start_signal",
             payload=None,
             qos=0,
             retain=True,
-            hostname="localhost"
+            kind=TRANSPORT_MQTT
         )
         print("[INFO] Cleared retained start signal.")
     except Exception as e:
@@ -1,24 +1,37 @@
+import argparse
+import functools
 import os
+import platform
 import subprocess
 import sys
 import time
-import threading
-from identity_registry import register_device
-from broker.subscriber import main as subscriber_main
-from config import MQTT_BROKER, MQTT_PORT
+from concurrent.futures import ThreadPoolExecutor
+from identity_registry import register_devices
+from broker.cluster import member_processes
+from utils.supervisor import ManagedProcess, Supervisor
+from utils.system_utils import probe_broker
+from utils.transport import TRANSPORT_INPROC
+from config import MQTT_BROKER, MQTT_PORT, CLUSTER_MODE, TRANSPORT
 
-DEVICES = ["device1", "device2"]  
-import platform
+print = functools.partial(print, flush=True)
+
+DEVICES = ["device1", "device2"]
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Seconds a startup stage may take to report ready before run_all gives up
+BROKER_READY_TIMEOUT = 15
+STAGE_READY_TIMEOUT = 30
+# Printed by device_sim.py once its connection is up
+SIMULATOR_READY = r"connected\."
 
 def start_mosquitto():
     if platform.system() == "Windows":
-  
+
         print("⚠️ Detected Windows OS: please start Mosquitto manually before running this script.")
-        return True  
+        return True
     else:
         try:
-            result = subprocess.run(["systemctl", "is-active", "--quiet", "mosquitto"])
-            if result.returncode == 0:
+            if probe_broker()[0]:
                 print("✅ Mosquitto broker is already running.")
                 return True
 
@@ -34,46 +47,90 @@ def start_mosquitto():
             print(f"⚠️ Error checking/starting mosquitto: {e}")
             return False
 
-def register_devices():
+def wait_for_broker(timeout=BROKER_READY_TIMEOUT):
+    # systemctl returns before mosquitto listens; a CONNACK is the real signal.
+    if not start_mosquitto():
+        return False
+    deadline = time.time() + timeout
+    while True:
+        running, detail, _ = probe_broker()
+        if running:
+            return True
+        if time.time() >= deadline:
+            print(f"❌ Broker at {MQTT_BROKER}:{MQTT_PORT} not reachable: {detail}")
+            return False
+        time.sleep(0.2)
+
+def prepare_registry():
     print("🔐 Registering devices...")
-    for device_id in DEVICES:
-        success, msg = register_device(device_id)
-        print(f"{'✅' if success else '❌'} {device_id}: {msg}")
-
-def start_subscriber():
-    print("📡 Starting subscriber...")
-    thread = threading.Thread(target=subscriber_main, daemon=True)
-    thread.start()
-    return thread
-
-def start_device_simulators():
-    print("📡 Starting device simulators...")
-    processes = []
-    for device_id in DEVICES:
-        cmd = [sys.executable, "device_sim.py", device_id]
-        proc = subprocess.Popen(cmd)
-        print(f"▶️ Started device simulator for {device_id} (pid {proc.pid})")
-        processes.append(proc)
-    return processes
+    for device_id, (success, msg) in register_devices(DEVICES).items():
+        print(f"{'✅' if success else 'ℹ️'} {device_id}: {msg}")
+
+def simulator_processes():
+    return [
+        ManagedProcess(f"sim-{device_id}", [sys.executable, "device_sim.py", device_id],
+                       cwd=BASE_DIR, ready_pattern=SIMULATOR_READY)
+        for device_id in DEVICES
+    ]
 
 def main():
-    if not start_mosquitto():
-        print("Please start Mosquitto broker manually and rerun.")
-        return
+    parser = argparse.ArgumentParser(description="Start and supervise the broker check, subscribers and simulators.")
+    parser.add_argument("--subscribers", type=int, default=1, help="subscriber processes (partitioned by device)")
+    args = parser.parse_args()
+
+    started = time.time()
+    supervisor = Supervisor()
+
+    def stage_ready(stage):
+        print(f"⏱  {stage} ready after {time.time() - started:.2f}s")
 
-    register_devices()
-    sub_thread = start_subscriber()
-    simulators = start_device_simulators()
+    def give_up(stage, waiting):
+        print(f"❌ {stage} not ready after {STAGE_READY_TIMEOUT}s: {', '.join(p.name for p in waiting)}")
+        sys.exit(1)
 
-    print("\n🚀 All systems started. Press Ctrl+C to exit.\n")
+    # Whatever ends startup or the run (Ctrl+C, a stage timing out, an error in
+    # a stage), the children started so far are stopped on the way out.
     try:
-        while True:
-            time.sleep(1)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            # Registering devices does not need the broker, so it overlaps with the broker check.
+            registry = pool.submit(prepare_registry)
+            if TRANSPORT == TRANSPORT_INPROC:
+                # Every simulator verifies its own messages in-process.
+                print("ℹ️ In-process transport: no broker or separate subscriber needed.")
+            else:
+                if not wait_for_broker():
+                    print("Please start Mosquitto broker manually and rerun.")
+                    return
+                stage_ready("Broker")
+                # Subscribers pick up registry changes on their own, so they start
+                # while devices may still be registering.
+                print("📡 Starting subscriber...")
+                subscribers = member_processes(max(1, args.subscribers), CLUSTER_MODE)
+                supervisor.add(*subscribers)
+            registry.result()
+            stage_ready("Registry")
+
+        if TRANSPORT != TRANSPORT_INPROC:
+            waiting = supervisor.wait_ready(subscribers, STAGE_READY_TIMEOUT)
+            if waiting:
+                give_up("Subscribers", waiting)
+            stage_ready("Subscribers")
+
+        print("📡 Starting device simulators...")
+        simulators = simulator_processes()
+        supervisor.add(*simulators)
+        waiting = supervisor.wait_ready(simulators, STAGE_READY_TIMEOUT)
+        if waiting:
+            give_up("Simulators", waiting)
+        stage_ready("Simulators")
+
+        print(f"\n🚀 All systems ready in {time.time() - started:.2f}s. Press Ctrl+C to exit.\n")
+        supervisor.run()
+        print("\n🛑 Shut down. Goodbye!")
     except KeyboardInterrupt:
         print("\n🛑 Shutting down...")
-        for proc in simulators:
-            proc.terminate()
-        print("Goodbye!")
+    finally:
+        supervisor.stop_all()
 
 if __name__ == "__main__":
     main()
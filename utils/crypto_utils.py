@@ -1,12 +1,31 @@
-from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature, encode_dss_signature
+
+# Registry "algorithm" values. Entries without one predate Ed25519 support and are P-256.
+ALGORITHM_P256 = "ecdsa-p256"
+ALGORITHM_ED25519 = "ed25519"
+KEY_ALGORITHMS = (ALGORITHM_P256, ALGORITHM_ED25519)
+ED25519_KEY_SIZE = 32
 
-def generate_keys():
-    private_key = ec.generate_private_key(ec.SECP256R1())
+def generate_keys(algorithm=ALGORITHM_P256):
+    if algorithm == ALGORITHM_ED25519:
+        private_key = ed25519.Ed25519PrivateKey.generate()
+    elif algorithm == ALGORITHM_P256:
+        private_key = ec.generate_private_key(ec.SECP256R1())
+    else:
+        raise ValueError(f"Unknown key algorithm: {algorithm}")
     public_key = private_key.public_key()
     return private_key, public_key
 
+def key_algorithm(key):
+    if isinstance(key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)):
+        return ALGORITHM_ED25519
+    if isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)) and key.curve.name == "secp256r1":
+        return ALGORITHM_P256
+    raise ValueError(f"Unsupported key type: {type(key).__name__}")
+
 def serialize_private_key(private_key):
     return private_key.private_bytes(
         encoding=serialization.Encoding.PEM,
@@ -33,7 +52,9 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import ec
 
 def sign_message(private_key, message: bytes) -> bytes:
-    
+    # P-256 signatures are DER; Ed25519 signatures are always 64 raw bytes.
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        return private_key.sign(message)
     signature = private_key.sign(
         message,
         signature_algorithm=ec.ECDSA(hashes.SHA256())
@@ -46,7 +67,47 @@ def load_private_key_from_file(file_path):
 
 def verify_signature(public_key, message_bytes, signature):
     try:
-        public_key.verify(signature, message_bytes, ec.ECDSA(hashes.SHA256()))
+        if isinstance(public_key, ed25519.Ed25519PublicKey):
+            public_key.verify(bytes(signature), message_bytes)
+        else:
+            public_key.verify(signature, message_bytes, ec.ECDSA(hashes.SHA256()))
         return True
     except InvalidSignature:
         return False
+
+def sign_raw(private_key, message):
+    # Fixed 64-byte signature for the binary envelopes, whatever the algorithm.
+    signature = sign_message(private_key, message)
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        return signature
+    return signature_to_raw(signature)
+
+def verify_raw(public_key, message_bytes, raw_signature):
+    if isinstance(public_key, ed25519.Ed25519PublicKey):
+        return verify_signature(public_key, message_bytes, raw_signature)
+    return verify_signature(public_key, message_bytes, signature_from_raw(raw_signature))
+
+def public_key_to_point(public_key):
+    # 65-byte uncompressed point for P-256, the 32-byte raw key for Ed25519.
+    if isinstance(public_key, ed25519.Ed25519PublicKey):
+        return public_key.public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw
+        )
+    return public_key.public_bytes(
+        encoding=serialization.Encoding.X962,
+        format=serialization.PublicFormat.UncompressedPoint
+    )
+
+def public_key_from_point(point):
+    if len(point) == ED25519_KEY_SIZE:
+        return ed25519.Ed25519PublicKey.from_public_bytes(bytes(point))
+    return ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), bytes(point))
+
+def signature_to_raw(der_signature):
+    r, s = decode_dss_signature(der_signature)
+    return r.to_bytes(32, "big") + s.to_bytes(32, "big")
+
+def signature_from_raw(raw_signature):
+    raw_signature = bytes(raw_signature)
+    return encode_dss_signature(int.from_bytes(raw_signature[:32], "big"), int.from_bytes(raw_signature[32:], "big"))
@@ -0,0 +1,327 @@
+import binascii
+import json
+import re
+import struct
+import time
+import zlib
+from collections import namedtuple
+from utils.crypto_utils import sign_message, sign_raw, verify_signature, verify_raw
+from utils.merkle import merkle_levels, merkle_proof, verify_proof
+from config import TOPIC_PATTERN, TOPIC_SHARDS, DATA_TOPIC, DEVICE_BATCH_SIZE, DEVICE_BATCH_WINDOW
+
+ENVELOPE_JSON = "json"
+ENVELOPE_DETACHED = "detached"
+ENVELOPE_BINARY = "binary"
+ENVELOPE_SESSION = "session"
+ENVELOPE_BATCH = "batch"
+ENVELOPE_FORMATS = (ENVELOPE_JSON, ENVELOPE_DETACHED, ENVELOPE_BINARY)
+# Formats carrying a fixed 64-byte signature (raw r||s for P-256) rather than
+# the key's native encoding; see verify_envelope().
+RAW_SIGNATURE_FORMATS = (ENVELOPE_BINARY, ENVELOPE_BATCH)
+
+# Detached envelope: <signature hex> "." <payload bytes exactly as signed>
+DETACHED_SEPARATOR = b"."
+MAX_SIGNATURE_HEX = 144
+
+# Binary envelope: header | schema fields | 64-byte raw signature (r||s or Ed25519).
+# Header is magic/version, schema id, registry device index, unix timestamp.
+BINARY_MAGIC = 0xB1
+BINARY_PREFIX = bytes((BINARY_MAGIC,))
+BINARY_HEADER = struct.Struct("<BBII")
+RAW_SIGNATURE_SIZE = 64
+
+# scale: stored as round(value * scale); choices: stored as the index into the tuple
+BinaryField = namedtuple("BinaryField", ["name", "fmt", "scale", "choices"])
+
+BINARY_SCHEMAS = {
+    1: (BinaryField("temperature", "h", 100, None), BinaryField("humidity", "H", 100, None)),
+    2: (BinaryField("light_intensity", "I", 100, None), BinaryField("status", "B", None, ("OFF", "ON"))),
+    3: (BinaryField("motion_detected", "?", None, None), BinaryField("sensitivity_level", "B", None, None)),
+}
+_BINARY_STRUCTS = {
+    schema_id: struct.Struct("<" + "".join(field.fmt for field in fields))
+    for schema_id, fields in BINARY_SCHEMAS.items()
+}
+
+# Session envelope: magic | session id | counter | payload JSON | truncated HMAC-SHA256.
+# See utils/session.py for the handshake that establishes the key.
+SESSION_MAGIC = 0xC1
+SESSION_PREFIX = bytes((SESSION_MAGIC,))
+SESSION_HEADER = struct.Struct("<B8sQ")
+SESSION_TAG_SIZE = 16
+
+# Batch envelope: header | Merkle root | 64-byte raw signature | readings.
+# Header is magic, reading count, unix time the batch was sealed; the
+# signature covers header + root only, and each reading is a u16
+# length-prefixed compact JSON object (a Merkle leaf).
+BATCH_MAGIC = 0xD1
+BATCH_PREFIX = bytes((BATCH_MAGIC,))
+BATCH_HEADER = struct.Struct("<BHI")
+BATCH_LENGTH = struct.Struct("<H")
+MERKLE_ROOT_SIZE = 32
+
+_TIMESTAMP_FIELD = re.compile(rb'"timestamp":\s*(-?\d+)')
+
+_TOPIC_ID_INDEX = TOPIC_PATTERN.split("/").index("+")
+
+# message is the exact byte sequence the signature covers. payload is None
+# until decode_payload() has been called, which should only happen after the
+# signature has been checked. leaves holds a batch envelope's readings.
+Envelope = namedtuple("Envelope", ["format", "device_id", "message", "signature", "payload", "leaves"],
+                      defaults=(None,))
+
+BinaryHeader = namedtuple("BinaryHeader", ["version", "schema", "device_index", "timestamp"])
+
+
+class EnvelopeError(ValueError):
+    pass
+
+
+def device_id_from_topic(topic):
+    if not topic:
+        return None
+    parts = topic.split("/")
+    if len(parts) <= _TOPIC_ID_INDEX:
+        return None
+    return parts[_TOPIC_ID_INDEX] or None
+
+
+def topic_shard(device_id, shards=TOPIC_SHARDS):
+    return zlib.crc32(device_id.encode()) % shards
+
+
+def data_topic(device_id):
+    return DATA_TOPIC.format(device_id=device_id, shard=topic_shard(device_id))
+
+
+def binary_schema_for(fields):
+    for schema_id, schema in BINARY_SCHEMAS.items():
+        if all(field.name in fields for field in schema):
+            return schema_id
+    raise EnvelopeError(f"No binary schema for fields {sorted(fields)}")
+
+
+def pack_binary_payload(payload, device_index):
+    fields = payload.get("data", payload)
+    schema_id = binary_schema_for(fields)
+    values = []
+    for field in BINARY_SCHEMAS[schema_id]:
+        value = fields[field.name]
+        if field.choices is not None:
+            value = field.choices.index(value)
+        elif field.scale is not None:
+            value = round(value * field.scale)
+        values.append(value)
+    header = BINARY_HEADER.pack(BINARY_MAGIC, schema_id, device_index, int(payload["timestamp"]))
+    return header + _BINARY_STRUCTS[schema_id].pack(*values)
+
+
+def unpack_binary_payload(message, device_id):
+    _, schema_id, _, timestamp = BINARY_HEADER.unpack_from(message)
+    values = _BINARY_STRUCTS[schema_id].unpack_from(message, BINARY_HEADER.size)
+    payload = {"device_id": device_id}
+    for field, value in zip(BINARY_SCHEMAS[schema_id], values):
+        if field.choices is not None:
+            value = field.choices[value]
+        elif field.scale is not None:
+            value = value / field.scale
+        payload[field.name] = value
+    payload["timestamp"] = timestamp
+    return payload
+
+
+def read_binary_header(raw):
+    return BinaryHeader(*BINARY_HEADER.unpack_from(raw))
+
+
+def encode_envelope(private_key, payload, fmt=ENVELOPE_DETACHED, device_index=None):
+    if fmt == ENVELOPE_JSON:
+        message_bytes = json.dumps(payload).encode()
+        signature = sign_message(private_key, message_bytes)
+        return json.dumps({"payload": payload, "signature": signature.hex()}).encode()
+
+    if fmt == ENVELOPE_DETACHED:
+        message_bytes = json.dumps(payload, separators=(",", ":")).encode()
+        signature = sign_message(private_key, message_bytes)
+        return signature.hex().encode() + DETACHED_SEPARATOR + message_bytes
+
+    if fmt == ENVELOPE_BINARY:
+        if device_index is None:
+            raise EnvelopeError("Binary envelopes need the device's registry index")
+        message_bytes = pack_binary_payload(payload, device_index)
+        return message_bytes + sign_raw(private_key, message_bytes)
+
+    raise EnvelopeError(f"Unknown envelope format: {fmt}")
+
+
+def encode_batch_envelope(private_key, payloads, sealed_at=None):
+    leaves = [json.dumps(payload, separators=(",", ":")).encode() for payload in payloads]
+    header = BATCH_HEADER.pack(BATCH_MAGIC, len(leaves), int(sealed_at or time.time()))
+    message_bytes = header + merkle_levels(leaves)[-1][0]
+    body = b"".join(BATCH_LENGTH.pack(len(leaf)) + leaf for leaf in leaves)
+    return message_bytes + sign_raw(private_key, message_bytes) + body
+
+
+def _parse_batch(raw, topic):
+    signed_size = BATCH_HEADER.size + MERKLE_ROOT_SIZE
+    if len(raw) < signed_size + RAW_SIGNATURE_SIZE:
+        raise EnvelopeError("Truncated batch envelope")
+    view = memoryview(raw)
+    _, count, _ = BATCH_HEADER.unpack_from(raw)
+    if count == 0:
+        raise EnvelopeError("Empty batch envelope")
+    leaves = []
+    offset = signed_size + RAW_SIGNATURE_SIZE
+    for _ in range(count):
+        if offset + BATCH_LENGTH.size > len(raw):
+            raise EnvelopeError("Truncated batch envelope")
+        (size,) = BATCH_LENGTH.unpack_from(raw, offset)
+        offset += BATCH_LENGTH.size
+        if offset + size > len(raw):
+            raise EnvelopeError("Truncated batch envelope")
+        leaves.append(view[offset:offset + size])
+        offset += size
+    if offset != len(raw):
+        raise EnvelopeError("Trailing bytes after batch readings")
+    # Binding the readings to the root is plain hashing; the (expensive)
+    # signature over the root is checked by the caller like any other.
+    if merkle_levels(leaves)[-1][0] != view[BATCH_HEADER.size:signed_size]:
+        raise EnvelopeError("Batch readings do not match the Merkle root")
+    signature = bytes(view[signed_size:signed_size + RAW_SIGNATURE_SIZE])
+    return Envelope(ENVELOPE_BATCH, device_id_from_topic(topic), view[:signed_size], signature, None, leaves)
+
+
+def batch_reading_proofs(envelope):
+    # (reading bytes, index, proof) per reading. With the envelope's message
+    # and signature each one can be re-verified on its own later, see
+    # verify_batch_reading().
+    levels = merkle_levels(envelope.leaves)
+    return [(bytes(leaf), index, merkle_proof(levels, index)) for index, leaf in enumerate(envelope.leaves)]
+
+
+def verify_batch_reading(message, reading, index, proof):
+    # Checks that reading is part of the batch whose signed header + root is
+    # message; the caller still has to verify the signature over message.
+    _, count, _ = BATCH_HEADER.unpack_from(message)
+    root = bytes(message[BATCH_HEADER.size:BATCH_HEADER.size + MERKLE_ROOT_SIZE])
+    return verify_proof(reading, index, count, proof, root)
+
+
+class ReadingBatcher:
+    # Device side: collects readings and seals them into one batch envelope
+    # once size readings are waiting or the oldest is window seconds old.
+    def __init__(self, private_key, size=DEVICE_BATCH_SIZE, window=DEVICE_BATCH_WINDOW):
+        self.private_key = private_key
+        self.size = size
+        self.window = window
+        self.readings = []
+        self.opened_at = None
+
+    def add(self, payload, now=None):
+        now = now or time.time()
+        if not self.readings:
+            self.opened_at = now
+        self.readings.append(payload)
+        if len(self.readings) >= self.size or now - self.opened_at >= self.window:
+            return self.flush(now)
+        return None
+
+    def flush(self, now=None):
+        if not self.readings:
+            return None
+        readings, self.readings = self.readings, []
+        return encode_batch_envelope(self.private_key, readings, now)
+
+
+def parse_envelope(raw, topic=None, resolve_index=None):
+    if raw[:1] == b"{":
+        data = json.loads(raw)
+        payload = data["payload"]
+        signature = bytes.fromhex(data["signature"])
+        # Legacy envelope: the signed bytes have to be rebuilt from the parsed payload.
+        message = json.dumps(payload).encode()
+        device_id = payload.get("device_id") if isinstance(payload, dict) else None
+        # Admission control and the partition filter go by the topic, so the
+        # payload may not speak for another device.
+        topic_id = device_id_from_topic(topic)
+        if topic_id is not None and device_id != topic_id:
+            raise EnvelopeError(f"device_id {device_id!r} does not match topic")
+        return Envelope(ENVELOPE_JSON, device_id, message, signature, payload)
+
+    if raw[:1] == BINARY_PREFIX:
+        if len(raw) < BINARY_HEADER.size + RAW_SIGNATURE_SIZE:
+            raise EnvelopeError("Truncated binary envelope")
+        header = read_binary_header(raw)
+        if header.schema not in BINARY_SCHEMAS:
+            raise EnvelopeError(f"Unknown binary schema {header.schema}")
+        expected = BINARY_HEADER.size + _BINARY_STRUCTS[header.schema].size + RAW_SIGNATURE_SIZE
+        if len(raw) != expected:
+            raise EnvelopeError("Binary envelope length does not match its schema")
+        device_id = resolve_index(header.device_index) if resolve_index else None
+        topic_id = device_id_from_topic(topic)
+        if topic_id is not None and device_id != topic_id:
+            raise EnvelopeError(f"Device index {header.device_index} does not match topic")
+        view = memoryview(raw)
+        signature = bytes(view[-RAW_SIGNATURE_SIZE:])
+        return Envelope(ENVELOPE_BINARY, device_id, view[:-RAW_SIGNATURE_SIZE], signature, None)
+
+    if raw[:1] == BATCH_PREFIX:
+        return _parse_batch(raw, topic)
+
+    if raw[:1] == SESSION_PREFIX:
+        if len(raw) < SESSION_HEADER.size + SESSION_TAG_SIZE:
+            raise EnvelopeError("Truncated session envelope")
+        view = memoryview(raw)
+        return Envelope(ENVELOPE_SESSION, device_id_from_topic(topic),
+                        view[:-SESSION_TAG_SIZE], view[-SESSION_TAG_SIZE:], None)
+
+    sep = raw.find(DETACHED_SEPARATOR, 0, MAX_SIGNATURE_HEX + 1)
+    if sep <= 0:
+        raise EnvelopeError("Unrecognised envelope")
+    view = memoryview(raw)
+    signature = binascii.unhexlify(view[:sep])
+    return Envelope(ENVELOPE_DETACHED, device_id_from_topic(topic), view[sep + 1:], signature, None)
+
+
+def verify_envelope(public_key, envelope):
+    if envelope.format in RAW_SIGNATURE_FORMATS:
+        return verify_raw(public_key, envelope.message, envelope.signature)
+    return verify_signature(public_key, envelope.message, envelope.signature)
+
+
+def claimed_timestamp(envelope):
+    # Unauthenticated until the signature has been checked: only good for
+    # cheap early rejection, never for updating state.
+    if envelope.payload is not None:
+        return envelope.payload.get("timestamp")
+    if envelope.format == ENVELOPE_BINARY:
+        return BINARY_HEADER.unpack_from(envelope.message)[3]
+    if envelope.format == ENVELOPE_BATCH:
+        return BATCH_HEADER.unpack_from(envelope.message)[2]
+    if envelope.format == ENVELOPE_DETACHED:
+        match = _TIMESTAMP_FIELD.search(envelope.message)
+        return int(match.group(1)) if match else None
+    return None
+
+
+def decode_payload(envelope):
+    if envelope.payload is not None:
+        return envelope
+    if envelope.format == ENVELOPE_BINARY:
+        return envelope._replace(payload=unpack_binary_payload(envelope.message, envelope.device_id))
+    if envelope.format == ENVELOPE_BATCH:
+        # The batch's timestamp is when it was sealed; readings keep their own.
+        readings = [json.loads(leaf.tobytes()) for leaf in envelope.leaves]
+        for reading in readings:
+            if reading.get("device_id") != envelope.device_id:
+                raise EnvelopeError(f"device_id {reading.get('device_id')!r} does not match topic")
+        timestamp = BATCH_HEADER.unpack_from(envelope.message)[2]
+        return envelope._replace(payload={"device_id": envelope.device_id, "timestamp": timestamp,
+                                          "readings": readings})
+    message = envelope.message
+    if envelope.format == ENVELOPE_SESSION:
+        message = message[SESSION_HEADER.size:]
+    payload = json.loads(message.tobytes())
+    if payload.get("device_id") != envelope.device_id:
+        raise EnvelopeError(f"device_id {payload.get('device_id')!r} does not match topic")
+    return envelope._replace(payload=payload)
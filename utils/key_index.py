@@ -0,0 +1,191 @@
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from utils.crypto_utils import deserialize_public_key, public_key_to_point, key_algorithm, ALGORITHM_P256, ALGORITHM_ED25519
+from utils.registry_store import open_registry_store
+from broker.event_log import print_line
+from config import KEY_INDEX_PATH
+
+# Precompiled public-key index, mmap'ed by the subscriber:
+#   header  | records sorted by (id hash, id) | (device index, record) pairs sorted by index | id strings
+# A record maps a device id to its public key bytes (65-byte uncompressed
+# P-256 point or 32-byte Ed25519 key, zero-padded), so lookups are a binary
+# search over the mapped file and no key object is built until a device
+# actually sends traffic.
+
+INDEX_MAGIC = b"IOTK"
+INDEX_VERSION = 2
+HEADER = struct.Struct("<4sHHIQQ")
+# id hash, key bytes, device index, id offset, id length, hash of the registry PEM, algorithm code
+RECORD = struct.Struct("<Q65sIIHQB")
+BY_INDEX = struct.Struct("<II")
+POINT_SIZE = 65
+ALGORITHM_CODES = {ALGORITHM_P256: 0, ALGORITHM_ED25519: 1}
+KEY_SIZES = {0: 65, 1: 32}
+
+
+class KeyIndexError(Exception):
+    pass
+
+
+def id_hash(device_id):
+    return int.from_bytes(hashlib.blake2b(device_id.encode(), digest_size=8).digest(), "little")
+
+
+def pem_hash(pem):
+    return int.from_bytes(hashlib.blake2b(pem.encode(), digest_size=8).digest(), "little")
+
+
+def build_key_index(entries, path=KEY_INDEX_PATH, previous=None, report=print_line):
+    # previous: an open KeyIndex whose points are reused for unchanged devices,
+    # so only new or changed entries pay for PEM parsing.
+    rows = []
+    indexes = set()
+    for device_id, info in entries.items():
+        # Binary envelopes name their device by index, so an entry without
+        # one (or sharing one) would resolve to somebody else's key.
+        device_index = info.get("index")
+        if not isinstance(device_index, int):
+            report(f"Skipping registry entry {device_id}: no device index")
+            continue
+        if device_index in indexes:
+            report(f"Skipping registry entry {device_id}: index {device_index} is already taken")
+            continue
+        pem = info["public_key"]
+        algorithm = ALGORITHM_CODES[info.get("algorithm", ALGORITHM_P256)]
+        hashed_pem = pem_hash(pem)
+        point = None
+        if previous is not None:
+            record = previous.find(device_id)
+            if record is not None and record[5] == hashed_pem and record[6] == algorithm:
+                point = record[1]
+        if point is None:
+            public_key = deserialize_public_key(pem)
+            if ALGORITHM_CODES[key_algorithm(public_key)] != algorithm:
+                report(f"Skipping registry entry {device_id}: key does not match its algorithm")
+                continue
+            point = public_key_to_point(public_key)
+        indexes.add(device_index)
+        rows.append((id_hash(device_id), device_id.encode(), point, device_index, hashed_pem, algorithm))
+    rows.sort()
+
+    records_offset = HEADER.size
+    by_index_offset = records_offset + RECORD.size * len(rows)
+    strings_offset = by_index_offset + BY_INDEX.size * len(rows)
+
+    records = bytearray()
+    strings = bytearray()
+    by_index = []
+    for record_no, (hashed, encoded_id, point, device_index, hashed_pem, algorithm) in enumerate(rows):
+        records += RECORD.pack(hashed, point, device_index, len(strings), len(encoded_id), hashed_pem, algorithm)
+        strings += encoded_id
+        by_index.append((device_index, record_no))
+    by_index.sort()
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".keyindex-", suffix=".tmp")
+    try:
+        os.chmod(tmp_path, 0o644)
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(INDEX_MAGIC, INDEX_VERSION, 0, len(rows), by_index_offset, strings_offset))
+            f.write(records)
+            for pair in by_index:
+                f.write(BY_INDEX.pack(*pair))
+            f.write(strings)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    report(f"✅ Wrote key index for {len(rows)} devices to {path}")
+    return len(rows)
+
+
+class KeyIndex:
+    def __init__(self, path=KEY_INDEX_PATH):
+        self.path = path
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            self.stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+            if st.st_size < HEADER.size:
+                raise KeyIndexError(f"{path} is truncated")
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.count, self._by_index_offset, self._strings_offset = HEADER.unpack_from(self._map)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            self.close()
+            raise KeyIndexError(f"{path} is not a version {INDEX_VERSION} key index")
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._map.close()
+
+    def _record(self, record_no):
+        record = RECORD.unpack_from(self._map, HEADER.size + record_no * RECORD.size)
+        # Strip the padding so callers always see the key's own encoding.
+        return (record[0], record[1][:KEY_SIZES[record[6]]]) + record[2:]
+
+    def _record_id(self, record):
+        start = self._strings_offset + record[3]
+        return self._map[start:start + record[4]].decode()
+
+    def find(self, device_id):
+        target = id_hash(device_id)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[0] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        while lo < self.count:
+            record = self._record(lo)
+            if record[0] != target:
+                break
+            if self._record_id(record) == device_id:
+                return record
+            lo += 1
+        return None
+
+    def lookup(self, device_id):
+        record = self.find(device_id)
+        return (record[1], record[2]) if record is not None else None
+
+    def device_for_index(self, device_index):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            idx, record_no = BY_INDEX.unpack_from(self._map, self._by_index_offset + mid * BY_INDEX.size)
+            if idx < device_index:
+                lo = mid + 1
+            elif idx > device_index:
+                hi = mid
+            else:
+                return self._record_id(self._record(record_no))
+        return None
+
+
+def rebuild_from_registry(path=KEY_INDEX_PATH, report=print_line):
+    previous = None
+    if os.path.exists(path):
+        try:
+            previous = KeyIndex(path)
+        except KeyIndexError:
+            previous = None
+    try:
+        return build_key_index(open_registry_store().load(), path, previous, report)
+    finally:
+        if previous is not None:
+            previous.close()
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else KEY_INDEX_PATH
+    rebuild_from_registry(path)
@@ -0,0 +1,33 @@
+import hashlib
+import os
+from config import PRIVATE_KEY_DIR, PUBLIC_KEY_DIR, KEY_DIR_SHARDING
+
+# Sharded layout: <dir>/<first two hex chars of sha1(device_id)>/<file>, which
+# keeps every directory to ~1/256th of the fleet. Keys written before sharding
+# live directly in <dir> and are still found by the resolve_* helpers.
+
+def key_shard(device_id):
+    return hashlib.sha1(device_id.encode()).hexdigest()[:2]
+
+def _key_path(base_dir, filename, device_id, sharded):
+    if sharded:
+        return os.path.join(base_dir, key_shard(device_id), filename)
+    return os.path.join(base_dir, filename)
+
+def private_key_path(device_id, base_dir=PRIVATE_KEY_DIR, sharded=KEY_DIR_SHARDING):
+    return _key_path(base_dir, f"{device_id}_private.pem", device_id, sharded)
+
+def public_key_path(device_id, base_dir=PUBLIC_KEY_DIR, sharded=KEY_DIR_SHARDING):
+    return _key_path(base_dir, f"{device_id}_public_key.pem", device_id, sharded)
+
+def _resolve(path_fn, device_id, base_dir):
+    sharded = path_fn(device_id, base_dir, sharded=True)
+    if os.path.exists(sharded):
+        return sharded
+    return path_fn(device_id, base_dir, sharded=False)
+
+def resolve_private_key_path(device_id, base_dir=PRIVATE_KEY_DIR):
+    return _resolve(private_key_path, device_id, base_dir)
+
+def resolve_public_key_path(device_id, base_dir=PUBLIC_KEY_DIR):
+    return _resolve(public_key_path, device_id, base_dir)
@@ -0,0 +1,61 @@
+import hashlib
+
+# Binary SHA-256 Merkle tree with domain-separated leaves and nodes, so a
+# leaf can never be passed off as an interior node. An odd node at the end of
+# a level is carried up unchanged rather than duplicated.
+
+LEAF_PREFIX = b"\x00"
+NODE_PREFIX = b"\x01"
+
+
+def leaf_hash(data):
+    return hashlib.sha256(LEAF_PREFIX + bytes(data)).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def merkle_levels(leaves):
+    # levels[0] are the leaf hashes, levels[-1] == [root]
+    if not leaves:
+        raise ValueError("Merkle tree needs at least one leaf")
+    level = [leaf_hash(leaf) for leaf in leaves]
+    levels = [level]
+    while len(level) > 1:
+        level = [
+            node_hash(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+            for i in range(0, len(level), 2)
+        ]
+        levels.append(level)
+    return levels
+
+
+def merkle_root(leaves):
+    return merkle_levels(leaves)[-1][0]
+
+
+def merkle_proof(levels, index):
+    # Sibling hashes from the leaf up; levels where the node had no sibling are skipped.
+    proof = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(level[sibling])
+        index //= 2
+    return proof
+
+
+def verify_proof(leaf, index, count, proof, root):
+    digest = leaf_hash(leaf)
+    siblings = iter(proof)
+    width = count
+    while width > 1:
+        if index ^ 1 < width:
+            sibling = next(siblings, None)
+            if sibling is None:
+                return False
+            digest = node_hash(sibling, digest) if index & 1 else node_hash(digest, sibling)
+        index //= 2
+        width = (width + 1) // 2
+    return next(siblings, None) is None and digest == root
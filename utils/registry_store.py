@@ -0,0 +1,213 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from utils.crypto_utils import ALGORITHM_P256
+from config import REGISTRY_BACKEND, REGISTRY_PATH, REGISTRY_DB_PATH
+
+
+class RegistryError(Exception):
+    pass
+
+
+def next_index(entries):
+    return max((info.get("index", 0) for info in entries.values()), default=0) + 1
+
+
+def write_json_atomic(path, data):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".registry-", suffix=".tmp")
+    try:
+        os.chmod(tmp_path, 0o644)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class JsonRegistryStore:
+    # The whole registry in one JSON file, replaced atomically on every write.
+    name = "json"
+    default_path = REGISTRY_PATH
+
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r") as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                raise RegistryError(f"Failed to decode {self.path}")
+
+    def get(self, device_id):
+        return self.load().get(device_id)
+
+    def registered(self, device_ids):
+        # The subset of device_ids already in the registry, from one read.
+        registry = self.load()
+        return {device_id for device_id in device_ids if device_id in registry}
+
+    def add_many(self, entries):
+        with self._lock:
+            registry = self.load()
+            duplicates = [device_id for device_id in entries if device_id in registry]
+            if duplicates:
+                raise RegistryError(f"Already registered: {', '.join(duplicates)}")
+            index = next_index(registry)
+            for device_id, info in entries.items():
+                registry[device_id] = dict(info, index=index)
+                index += 1
+            write_json_atomic(self.path, registry)
+
+    def import_json(self, path):
+        with open(path, "r") as f:
+            entries = json.load(f)
+        with self._lock:
+            write_json_atomic(self.path, entries)
+        return len(entries)
+
+    def export_json(self, path):
+        entries = self.load()
+        write_json_atomic(path, entries)
+        return len(entries)
+
+
+class SqliteRegistryStore:
+    # Indexed registry: primary-key lookups are O(log n) and bulk registrations
+    # commit in a single transaction. Readers use WAL, so they never block on
+    # (or see half of) a write.
+    name = "sqlite"
+    default_path = REGISTRY_DB_PATH
+
+    def __init__(self, path=REGISTRY_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS devices ("
+                " device_id TEXT PRIMARY KEY,"
+                " idx INTEGER UNIQUE NOT NULL,"
+                " public_key TEXT NOT NULL,"
+                f" algorithm TEXT NOT NULL DEFAULT '{ALGORITHM_P256}')"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(devices)")}
+            if "algorithm" not in columns:
+                # Databases created before per-device algorithms were all P-256.
+                conn.execute(f"ALTER TABLE devices ADD COLUMN algorithm TEXT NOT NULL DEFAULT '{ALGORITHM_P256}'")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def stamp(self):
+        row = self._connect().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0] if row else None
+
+    def exists(self):
+        return True
+
+    @staticmethod
+    def _entry(idx, public_key, algorithm):
+        return {"public_key": public_key, "index": idx, "algorithm": algorithm}
+
+    def load(self):
+        rows = self._connect().execute("SELECT device_id, idx, public_key, algorithm FROM devices")
+        return {device_id: self._entry(idx, pem, algorithm) for device_id, idx, pem, algorithm in rows}
+
+    def get(self, device_id):
+        row = self._connect().execute(
+            "SELECT idx, public_key, algorithm FROM devices WHERE device_id = ?", (device_id,)
+        ).fetchone()
+        return self._entry(*row) if row else None
+
+    def registered(self, device_ids, chunk_size=500):
+        device_ids = list(device_ids)
+        conn = self._connect()
+        found = set()
+        for start in range(0, len(device_ids), chunk_size):
+            chunk = device_ids[start:start + chunk_size]
+            rows = conn.execute(
+                f"SELECT device_id FROM devices WHERE device_id IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            found.update(device_id for (device_id,) in rows)
+        return found
+
+    def add_many(self, entries, replace=False):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                if replace:
+                    conn.execute("DELETE FROM devices")
+                index = conn.execute("SELECT COALESCE(MAX(idx), 0) + 1 FROM devices").fetchone()[0]
+                index = max([index] + [info["index"] + 1 for info in entries.values() if "index" in info])
+                rows = []
+                for device_id, info in entries.items():
+                    algorithm = info.get("algorithm", ALGORITHM_P256)
+                    if replace and "index" in info:
+                        rows.append((device_id, info["index"], info["public_key"], algorithm))
+                    else:
+                        rows.append((device_id, index, info["public_key"], algorithm))
+                        index += 1
+                conn.executemany(
+                    "INSERT INTO devices (device_id, idx, public_key, algorithm) VALUES (?, ?, ?, ?)", rows
+                )
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+        except sqlite3.IntegrityError as e:
+            raise RegistryError(f"Registration rejected: {e}")
+
+    def import_json(self, path):
+        with open(path, "r") as f:
+            entries = json.load(f)
+        self.add_many(entries, replace=True)
+        return len(entries)
+
+    def export_json(self, path):
+        entries = self.load()
+        write_json_atomic(path, entries)
+        return len(entries)
+
+
+REGISTRY_BACKENDS = {
+    JsonRegistryStore.name: JsonRegistryStore,
+    SqliteRegistryStore.name: SqliteRegistryStore,
+}
+
+
+def open_registry_store(backend=REGISTRY_BACKEND, base_dir=None):
+    # base_dir: resolve the configured path against it instead of the cwd.
+    try:
+        store_class = REGISTRY_BACKENDS[backend]
+    except KeyError:
+        raise RegistryError(f"Unknown registry backend: {backend}")
+    if base_dir is None:
+        return store_class()
+    return store_class(os.path.join(base_dir, store_class.default_path))
@@ -0,0 +1,297 @@
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from utils.crypto_utils import public_key_to_point, public_key_from_point, verify_signature
+from utils.envelope import (
+    encode_envelope, parse_envelope, decode_payload, topic_shard, ENVELOPE_DETACHED,
+    SESSION_MAGIC, SESSION_HEADER, SESSION_TAG_SIZE,
+)
+from config import (
+    SESSION_INIT_TOPIC, SESSION_ACK_TOPIC, SESSION_TTL, SESSION_MAX_MESSAGES,
+    SESSION_REKEY_MARGIN, SESSION_HANDSHAKE_SKEW, SESSION_REPLAY_WINDOW,
+)
+
+# Handshake:
+#   device -> iot/<id>/session/init : detached envelope signed with the device's
+#       registered key over {device_id, ephemeral_key, nonce, timestamp}
+#   subscriber -> iot/<id>/session/ack : {session_id, ephemeral_key, nonce,
+#       expires_at, max_messages, confirm}
+# Both sides run ECDH on the ephemeral keys and HKDF the shared secret with
+# both nonces. "confirm" is an HMAC under the new key so the device knows the
+# subscriber derived the same key. Telemetry is then authenticated with a
+# truncated HMAC-SHA256 over the session envelope (see utils/envelope.py).
+# A message naming a session the subscriber does not know (it restarted, or
+# pruned the session) gets {session_id, error} on the ack topic, and the
+# device re-handshakes instead of sending into the void until its TTL.
+
+SESSION_INFO = b"iot-auth session v1"
+UNKNOWN_SESSION = "unknown session"
+
+
+class SessionError(ValueError):
+    pass
+
+
+def derive_session_key(private_key, peer_point, device_nonce, server_nonce, device_id, session_id):
+    shared = private_key.exchange(ec.ECDH(), public_key_from_point(peer_point))
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=device_nonce + server_nonce,
+        info=SESSION_INFO + device_id.encode() + session_id,
+    ).derive(shared)
+
+
+def session_tag(key, message):
+    return hmac.new(key, message, hashlib.sha256).digest()[:SESSION_TAG_SIZE]
+
+
+def confirmation(key, session_id):
+    return hmac.new(key, b"ack" + session_id, hashlib.sha256).hexdigest()
+
+
+class DeviceSession:
+    def __init__(self, device_id, private_key):
+        self.device_id = device_id
+        self.private_key = private_key
+        self.key = None
+        self.session_id = None
+        self.counter = 0
+        self.expires_at = 0
+        self.max_messages = 0
+        self._pending = None
+        self._lock = threading.Lock()
+
+    @property
+    def init_topic(self):
+        return SESSION_INIT_TOPIC.format(device_id=self.device_id, shard=topic_shard(self.device_id))
+
+    @property
+    def ack_topic(self):
+        return SESSION_ACK_TOPIC.format(device_id=self.device_id)
+
+    def established(self):
+        with self._lock:
+            return self.key is not None and time.time() < self.expires_at and self.counter < self.max_messages
+
+    def needs_rekey(self):
+        with self._lock:
+            if self._pending is not None and time.time() - self._pending[2] < SESSION_HANDSHAKE_SKEW:
+                return False
+            if self.key is None:
+                return True
+            return (time.time() >= self.expires_at - SESSION_REKEY_MARGIN
+                    or self.counter >= self.max_messages * 0.9)
+
+    def handshake_message(self):
+        ephemeral = ec.generate_private_key(ec.SECP256R1())
+        nonce = os.urandom(16)
+        with self._lock:
+            self._pending = (ephemeral, nonce, time.time())
+        hello = {
+            "device_id": self.device_id,
+            "ephemeral_key": public_key_to_point(ephemeral.public_key()).hex(),
+            "nonce": nonce.hex(),
+            "timestamp": int(time.time()),
+        }
+        return encode_envelope(self.private_key, hello, ENVELOPE_DETACHED)
+
+    def accept(self, raw):
+        # True once the ack established a new session, False if the subscriber
+        # rejected the current one (needs_rekey() is then True).
+        ack = json.loads(raw)
+        session_id = bytes.fromhex(ack["session_id"])
+        if "error" in ack:
+            with self._lock:
+                if session_id != self.session_id:
+                    raise SessionError(f"Rejection names an old session: {ack['error']}")
+                self.key = None
+                self.session_id = None
+            return False
+        with self._lock:
+            pending = self._pending
+        if pending is None:
+            raise SessionError("No handshake in progress")
+        ephemeral, nonce, _ = pending
+        key = derive_session_key(ephemeral, bytes.fromhex(ack["ephemeral_key"]), nonce,
+                                 bytes.fromhex(ack["nonce"]), self.device_id, session_id)
+        if not hmac.compare_digest(confirmation(key, session_id), ack["confirm"]):
+            raise SessionError("Session confirmation failed")
+        with self._lock:
+            if self._pending is pending:
+                self._pending = None
+            self.key = key
+            self.session_id = session_id
+            self.counter = 0
+            self.expires_at = ack["expires_at"]
+            self.max_messages = ack["max_messages"]
+        return True
+
+    def seal(self, payload):
+        with self._lock:
+            if self.key is None:
+                raise SessionError("No session established")
+            self.counter += 1
+            header = SESSION_HEADER.pack(SESSION_MAGIC, self.session_id, self.counter)
+            message = header + json.dumps(payload, separators=(",", ":")).encode()
+            return message + session_tag(self.key, message)
+
+
+class ServerSession:
+    __slots__ = ("device_id", "key", "expires_at", "max_messages", "last_counter", "seen", "used")
+
+    def __init__(self, device_id, key, expires_at, max_messages):
+        self.device_id = device_id
+        self.key = key
+        self.expires_at = expires_at
+        self.max_messages = max_messages
+        self.last_counter = 0
+        # Bit i set: counter last_counter - i has been accepted.
+        self.seen = 0
+        self.used = False
+
+    def advance(self, counter, window):
+        # Sliding replay window: counters may arrive out of order, but each
+        # only once and no more than window behind the highest seen.
+        if counter > self.last_counter:
+            self.seen = ((self.seen << (counter - self.last_counter)) | 1) & ((1 << window) - 1)
+            self.last_counter = counter
+            return True
+        offset = self.last_counter - counter
+        if offset >= window or self.seen & (1 << offset):
+            return False
+        self.seen |= 1 << offset
+        return True
+
+
+class SessionTable:
+    def __init__(self, ttl=SESSION_TTL, max_messages=SESSION_MAX_MESSAGES, replay_window=SESSION_REPLAY_WINDOW):
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.replay_window = replay_window
+        self._sessions = {}
+        # The session a device is using plus at most one it has not used yet,
+        # so the device keeps sending while its re-key is in flight.
+        self._by_device = {}
+        # Handshake nonces seen while their timestamp could still pass the
+        # skew check, so a captured init cannot be replayed.
+        self._hellos = OrderedDict()
+        # device_id -> when it was last told its session is unknown
+        self._rejections = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def handshake(self, raw, topic, public_key):
+        envelope = parse_envelope(raw, topic)
+        if not verify_signature(public_key, envelope.message, envelope.signature):
+            raise SessionError("Invalid handshake signature")
+        hello = decode_payload(envelope).payload
+        if abs(time.time() - hello["timestamp"]) > SESSION_HANDSHAKE_SKEW:
+            raise SessionError("Stale handshake")
+        self._first_hello(bytes.fromhex(hello["nonce"]))
+
+        ephemeral = ec.generate_private_key(ec.SECP256R1())
+        session_id = os.urandom(8)
+        nonce = os.urandom(16)
+        key = derive_session_key(ephemeral, bytes.fromhex(hello["ephemeral_key"]),
+                                 bytes.fromhex(hello["nonce"]), nonce, envelope.device_id, session_id)
+        expires_at = int(time.time()) + self.ttl
+        self._add(session_id, ServerSession(envelope.device_id, key, expires_at, self.max_messages))
+        ack = {
+            "session_id": session_id.hex(),
+            "ephemeral_key": public_key_to_point(ephemeral.public_key()).hex(),
+            "nonce": nonce.hex(),
+            "expires_at": expires_at,
+            "max_messages": self.max_messages,
+            "confirm": confirmation(key, session_id),
+        }
+        return SESSION_ACK_TOPIC.format(device_id=envelope.device_id), json.dumps(ack)
+
+    def _first_hello(self, nonce):
+        now = time.time()
+        with self._lock:
+            hellos = self._hellos
+            while hellos and next(iter(hellos.values())) <= now:
+                hellos.popitem(last=False)
+            if nonce in hellos:
+                raise SessionError("Replayed handshake")
+            hellos[nonce] = now + 2 * SESSION_HANDSHAKE_SKEW
+
+    def _add(self, session_id, session):
+        with self._lock:
+            ids = self._by_device.setdefault(session.device_id, [])
+            # An earlier handshake the device never sent with is superseded.
+            for unused in [sid for sid in ids if not self._sessions[sid].used]:
+                ids.remove(unused)
+                del self._sessions[unused]
+            ids.append(session_id)
+            self._sessions[session_id] = session
+
+    def _first_use(self, session_id, session):
+        # The device switched over, so the session it used before can go.
+        session.used = True
+        ids = self._by_device.get(session.device_id, [])
+        for old in [sid for sid in ids if sid != session_id and self._sessions[sid].used]:
+            ids.remove(old)
+            del self._sessions[old]
+
+    def verify(self, envelope):
+        _, session_id, counter = SESSION_HEADER.unpack_from(envelope.message)
+        session = self._sessions.get(bytes(session_id))
+        if session is None:
+            return False, UNKNOWN_SESSION
+        if session.device_id != envelope.device_id:
+            return False, "session belongs to another device"
+        if time.time() >= session.expires_at or counter > session.max_messages:
+            self.expire(bytes(session_id))
+            return False, "session expired"
+        if not hmac.compare_digest(session_tag(session.key, envelope.message), envelope.signature):
+            return False, "bad session tag"
+        with self._lock:
+            if not session.advance(counter, self.replay_window):
+                return False, "replayed counter"
+            if not session.used:
+                self._first_use(bytes(session_id), session)
+        return True, None
+
+    def rejection(self, envelope):
+        # (ack topic, message) telling the device its session is unknown, at
+        # most once per SESSION_HANDSHAKE_SKEW per device; None otherwise.
+        device_id = envelope.device_id
+        now = time.time()
+        with self._lock:
+            rejections = self._rejections
+            while rejections and next(iter(rejections.values())) <= now - SESSION_HANDSHAKE_SKEW:
+                rejections.popitem(last=False)
+            if device_id in rejections:
+                return None
+            rejections[device_id] = now
+        _, session_id, _ = SESSION_HEADER.unpack_from(envelope.message)
+        message = {"session_id": bytes(session_id).hex(), "error": UNKNOWN_SESSION}
+        return SESSION_ACK_TOPIC.format(device_id=device_id), json.dumps(message)
+
+    def expire(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                ids = self._by_device.get(session.device_id, [])
+                if session_id in ids:
+                    ids.remove(session_id)
+                if not ids:
+                    self._by_device.pop(session.device_id, None)
+
+    def prune(self):
+        now = time.time()
+        expired = [sid for sid, session in list(self._sessions.items()) if now >= session.expires_at]
+        for session_id in expired:
+            self.expire(session_id)
+        return len(expired)
@@ -0,0 +1,154 @@
+import functools
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+print = functools.partial(print, flush=True)
+
+# Starts child processes, forwards their output line by line with a
+# "[name]" prefix and restarts any that exit, backing off exponentially
+# while a process keeps crashing. A process with a ready_pattern counts as
+# ready once a line of its output matches it; without one it is ready as soon
+# as it has started.
+
+
+class ManagedProcess:
+    def __init__(self, name, cmd, cwd=None, env=None, restart=True,
+                 backoff=1.0, max_backoff=30.0, healthy_after=10.0, ready_pattern=None):
+        self.name = name
+        self.cmd = cmd
+        self.cwd = cwd
+        self.env = env
+        self.restart = restart
+        self.initial_backoff = backoff
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.healthy_after = healthy_after
+        self.proc = None
+        self.started_at = None
+        self.restart_at = None
+        self.restarts = 0
+        self.ready_pattern = re.compile(ready_pattern) if ready_pattern else None
+        self.ready = threading.Event()
+        self.ready_after = None
+
+    def start(self):
+        env = dict(os.environ, PYTHONUNBUFFERED="1", **(self.env or {}))
+        self.proc = subprocess.Popen(self.cmd, cwd=self.cwd, env=env, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, text=True, bufsize=1)
+        self.started_at = time.time()
+        self.restart_at = None
+        self.ready.clear()
+        self.ready_after = None
+        threading.Thread(target=self._forward, args=(self.proc,), name=f"{self.name}-output", daemon=True).start()
+        print(f"▶️ Started {self.name} (pid {self.proc.pid})")
+        if self.ready_pattern is None:
+            self._mark_ready()
+
+    def _forward(self, proc):
+        for line in proc.stdout:
+            self.on_line(line.rstrip("\n"))
+
+    def on_line(self, line):
+        print(f"[{self.name}] {line}")
+        if self.ready_pattern is not None and not self.ready.is_set() and self.ready_pattern.search(line):
+            self._mark_ready()
+            print(f"✅ {self.name} ready in {self.ready_after:.2f}s"
+                  + (f" (restart {self.restarts})" if self.restarts else ""))
+
+    def _mark_ready(self):
+        self.ready_after = time.time() - self.started_at
+        self.ready.set()
+
+    def running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def check(self, now):
+        # Returns True when the process was (re)started by this call.
+        if self.proc is None or self.running():
+            return False
+        if self.restart_at is None:
+            code = self.proc.returncode
+            if not self.restart:
+                print(f"⚠️ {self.name} exited with code {code}")
+                self.proc = None
+                return False
+            self.ready.clear()
+            if now - self.started_at >= self.healthy_after:
+                self.backoff = self.initial_backoff
+            self.restart_at = now + self.backoff
+            print(f"⚠️ {self.name} exited with code {code}; restarting in {self.backoff:g}s")
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            return False
+        if now >= self.restart_at:
+            self.restarts += 1
+            self.start()
+            return True
+        return False
+
+    def stop(self, timeout=5):
+        self.ready.clear()
+        proc, self.proc = self.proc, None
+        if proc is None or proc.poll() is not None:
+            return
+        proc.send_signal(signal.SIGINT if os.name != "nt" else signal.SIGTERM)
+        try:
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+class Supervisor:
+    def __init__(self, processes=(), poll_interval=0.5):
+        self.processes = list(processes)
+        self.poll_interval = poll_interval
+        self.stopping = threading.Event()
+
+    def start_all(self):
+        for process in self.processes:
+            process.start()
+
+    def add(self, *processes):
+        for process in processes:
+            self.processes.append(process)
+            process.start()
+
+    def check_all(self):
+        now = time.time()
+        for process in self.processes:
+            process.check(now)
+
+    def wait_ready(self, processes, timeout):
+        # Keeps supervising (restarting crashed processes) while it waits;
+        # returns the processes that did not become ready in time.
+        deadline = time.time() + timeout
+        while not self.stopping.is_set():
+            waiting = [process for process in processes if not process.ready.is_set()]
+            if not waiting or time.time() >= deadline:
+                return waiting
+            self.check_all()
+            waiting[0].ready.wait(min(self.poll_interval, max(0.0, deadline - time.time())))
+        return list(processes)
+
+    def run(self):
+        try:
+            while not self.stopping.wait(self.poll_interval):
+                self.check_all()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop_all()
+
+    def stop_all(self):
+        self.stopping.set()
+        for process in self.processes:
+            process.stop()
+
+
+def python_module(module, *args):
+    return [sys.executable, "-m", module, *map(str, args)]
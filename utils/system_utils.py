@@ -1,16 +1,150 @@
+import os
+import socket
+import struct
+import threading
+import time
+from collections import namedtuple
+from utils.transport import MqttTransport
+from config import MQTT_BROKER, MQTT_PORT, BROKER_HEALTH_INTERVAL, BROKER_HEALTH_TIMEOUT, BROKER_SYS_STATS
 
-import subprocess
-import platform
+BrokerStatus = namedtuple("BrokerStatus", ["running", "detail", "latency", "checked_at", "stats"])
 
-def check_mosquitto_running():
-    system = platform.system()
+# $SYS topics (mosquitto) shown next to the broker status
+SYS_TOPICS = {
+    "$SYS/broker/clients/connected": "clients",
+    "$SYS/broker/load/messages/received/1min": "received_per_min",
+    "$SYS/broker/load/messages/sent/1min": "sent_per_min",
+    "$SYS/broker/subscriptions/count": "subscriptions",
+}
+
+CONNACK_CODES = {
+    1: "unacceptable protocol version",
+    2: "client id rejected",
+    3: "server unavailable",
+    4: "bad credentials",
+    5: "not authorized",
+}
+
+
+def _connect_packet(client_id):
+    encoded = client_id.encode()
+    # protocol "MQTT", level 4 (3.1.1), clean session, keepalive 5s
+    body = b"\x00\x04MQTT\x04\x02\x00\x05" + struct.pack("!H", len(encoded)) + encoded
+    return bytes([0x10, len(body)]) + body
+
+
+def _recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed by broker")
+        data += chunk
+    return data
+
+
+def probe_broker(host=MQTT_BROKER, port=MQTT_PORT, timeout=BROKER_HEALTH_TIMEOUT):
+    # MQTT CONNECT -> CONNACK round trip; returns (accepting, detail, seconds).
+    started = time.perf_counter()
     try:
-        if system == "Windows":
-            output = subprocess.check_output("tasklist", shell=True).decode()
-            return "mosquitto.exe" in output
-        else:
-            output = subprocess.check_output(["ps", "aux"]).decode()
-            return "mosquitto" in output
-    except Exception as e:
-        print(f"Error checking Mosquitto status: {e}")
-        return False
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.settimeout(timeout)
+            sock.sendall(_connect_packet(f"health-{os.getpid()}"))
+            header, _, _, code = _recv_exact(sock, 4)
+            latency = time.perf_counter() - started
+            if header != 0x20:
+                return False, f"unexpected reply 0x{header:02x}", latency
+            try:
+                sock.sendall(b"\xe0\x00")
+            except OSError:
+                pass
+    except OSError as e:
+        return False, str(e) or type(e).__name__, time.perf_counter() - started
+    if code:
+        # The broker is up but refuses anonymous clients.
+        return True, f"refused: {CONNACK_CODES.get(code, code)}", latency
+    return True, "accepting connections", latency
+
+
+def check_mosquitto_running():
+    return probe_broker()[0]
+
+
+class BrokerHealthMonitor:
+    # Probes the broker every interval from one background thread and caches
+    # the result; on_change(status) fires only when liveness or detail changes,
+    # or when new $SYS numbers arrive.
+    def __init__(self, on_change=None, host=MQTT_BROKER, port=MQTT_PORT,
+                 interval=BROKER_HEALTH_INTERVAL, sys_stats=BROKER_SYS_STATS):
+        self.on_change = on_change
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.sys_stats = sys_stats
+        self.status = BrokerStatus(None, "not checked yet", None, None, {})
+        self.stats = {}
+        self._stats_changed = False
+        self._force_push = False
+        self._sys_client = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name="broker-health", daemon=True).start()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+        if self._sys_client is not None:
+            self._sys_client.loop_stop()
+            self._sys_client.disconnect()
+
+    def refresh(self, force=False):
+        # force: report the next result even if nothing changed
+        self._force_push = self._force_push or force
+        self._wake.set()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self.check()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def check(self):
+        running, detail, latency = probe_broker(self.host, self.port)
+        previous = self.status
+        self.status = BrokerStatus(running, detail, latency, time.time(), dict(self.stats))
+        if running and self.sys_stats and self._sys_client is None:
+            self._watch_sys()
+        changed = (running, detail) != (previous.running, previous.detail) or self._stats_changed or self._force_push
+        self._stats_changed = self._force_push = False
+        if changed and self.on_change is not None:
+            self.on_change(self.status)
+        return self.status
+
+    def _watch_sys(self):
+        client = MqttTransport(f"health-sys-{os.getpid()}", self.host, self.port)
+        client.on_connect = self._subscribe_sys
+        client.on_message = self._on_sys_message
+        try:
+            client.connect()
+        except OSError:
+            return
+        client.loop_start()
+        self._sys_client = client
+
+    def _subscribe_sys(self, client):
+        for topic in SYS_TOPICS:
+            client.subscribe(topic)
+
+    def _on_sys_message(self, client, userdata, msg):
+        name = SYS_TOPICS.get(msg.topic)
+        if name is None:
+            return
+        try:
+            value = float(msg.payload.decode())
+        except ValueError:
+            return
+        if self.stats.get(name) != value:
+            self.stats[name] = value
+            self._stats_changed = True
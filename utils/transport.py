@@ -0,0 +1,160 @@
+import threading
+import paho.mqtt.client as mqtt
+import paho.mqtt.publish as mqtt_publish
+from config import TRANSPORT, MQTT_BROKER, MQTT_PORT
+
+# Transports expose the subset of the paho client API the project uses
+# (connect/subscribe/publish/loop_*), with on_message(transport, userdata, msg)
+# and on_connect(transport) callbacks, so callers do not care what carries the
+# bytes. "mqtt" goes through the broker; "inproc" hands the publisher's buffer
+# straight to subscribers living in the same process.
+
+TRANSPORT_MQTT = "mqtt"
+TRANSPORT_INPROC = "inproc"
+
+
+class InProcessMessage:
+    __slots__ = ("topic", "payload", "qos", "retain")
+
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class MqttTransport:
+    def __init__(self, client_id="", host=MQTT_BROKER, port=MQTT_PORT, protocol=mqtt.MQTTv311):
+        self.host = host
+        self.port = port
+        self.on_message = None
+        self.on_connect = None
+        self.client = mqtt.Client(client_id=client_id, protocol=protocol,
+                                  callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+        self.client.on_message = self._dispatch
+        self.client.on_connect = self._connected
+        self.connected = threading.Event()
+
+    def _dispatch(self, client, userdata, msg):
+        if self.on_message is not None:
+            self.on_message(self, userdata, msg)
+
+    def _connected(self, client, userdata, flags, reason_code, properties=None):
+        if reason_code.is_failure:
+            print(f"MQTT connection refused: {reason_code}", flush=True)
+            return
+        self.connected.set()
+        if self.on_connect is not None:
+            self.on_connect(self)
+
+    def connect(self, keepalive=60):
+        self.client.connect(self.host, self.port, keepalive)
+
+    def subscribe(self, pattern, qos=0, **options):
+        self.client.subscribe(pattern, qos, **options)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        return self.client.publish(topic, payload, qos=qos, retain=retain)
+
+    def loop_start(self):
+        self.client.loop_start()
+
+    def loop_stop(self):
+        self.client.loop_stop()
+
+    def loop_forever(self):
+        self.client.loop_forever()
+
+    def disconnect(self):
+        self.client.disconnect()
+
+
+class InProcessHub:
+    def __init__(self):
+        self._subscriptions = []
+        self._retained = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, transport, pattern):
+        with self._lock:
+            self._subscriptions.append((pattern, transport))
+            retained = [(t, m) for t, m in self._retained.items() if mqtt.topic_matches_sub(pattern, t)]
+        for _, message in retained:
+            transport.deliver(message)
+
+    def unsubscribe_all(self, transport):
+        with self._lock:
+            self._subscriptions = [(p, t) for p, t in self._subscriptions if t is not transport]
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        message = InProcessMessage(topic, payload, qos, retain)
+        with self._lock:
+            if retain:
+                if payload:
+                    self._retained[topic] = InProcessMessage(topic, payload, qos, True)
+                else:
+                    self._retained.pop(topic, None)
+            targets = [t for p, t in self._subscriptions if mqtt.topic_matches_sub(p, topic)]
+        for transport in targets:
+            transport.deliver(message)
+
+
+hub = InProcessHub()
+
+
+class InProcessTransport:
+    # Delivery runs synchronously on the publisher's thread with the very
+    # same bytes object, so no serialization, socket or copy is involved.
+    def __init__(self, client_id="", hub=hub):
+        self.client_id = client_id
+        self.hub = hub
+        self.on_message = None
+        self.on_connect = None
+        self.connected = threading.Event()
+        self._stopped = threading.Event()
+
+    def deliver(self, message):
+        if self.on_message is not None and self.connected.is_set():
+            self.on_message(self, None, message)
+
+    def connect(self, keepalive=60):
+        self.connected.set()
+        if self.on_connect is not None:
+            self.on_connect(self)
+
+    def subscribe(self, pattern, qos=0, **options):
+        self.hub.subscribe(self, pattern)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.hub.publish(topic, payload, qos, retain)
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        self._stopped.set()
+
+    def loop_forever(self):
+        self._stopped.wait()
+
+    def disconnect(self):
+        self.hub.unsubscribe_all(self)
+        self.connected.clear()
+        self._stopped.set()
+
+
+def create_transport(kind=TRANSPORT, client_id="", **options):
+    if kind == TRANSPORT_MQTT:
+        return MqttTransport(client_id, **options)
+    if kind == TRANSPORT_INPROC:
+        return InProcessTransport(client_id)
+    raise ValueError(f"Unknown transport: {kind}")
+
+
+def publish_single(topic, payload=None, qos=0, retain=False, kind=TRANSPORT):
+    if kind == TRANSPORT_INPROC:
+        hub.publish(topic, payload, qos, retain)
+    else:
+        mqtt_publish.single(topic, payload=payload, qos=qos, retain=retain, hostname=MQTT_BROKER, port=MQTT_PORT)